@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Сравнение прежнего расчёта медианы (running_median_insort, O(n^2) на url) с select_kth
+на перекошенном распределении: один url получает половину всего трафика.
+
+    python benchmarks/bench_median.py --requests 200000 --urls 1000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+from bisect import insort, bisect_left
+from collections import deque
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_analyzer import select_kth  # noqa: E402
+
+
+def running_median_insort(seq, window_size=1000):
+    """Реализация из calculate_metrics до перехода на select_kth"""
+    seq = iter(seq)
+    d = deque()
+    s = []
+    result = []
+    for item in islice(seq, window_size):
+        d.append(item)
+        insort(s, item)
+        result.append(s[len(d) // 2])
+    m = window_size // 2
+    for item in seq:
+        old = d.popleft()
+        d.append(item)
+        del s[bisect_left(s, old)]
+        insort(s, item)
+        result.append(s[m])
+    return result
+
+
+def generate_skewed_table(num_requests, num_urls, seed=42):
+    rnd = random.Random(seed)
+    table = {'/hot': array('d')}
+    for _ in range(num_requests // 2):
+        table['/hot'].append(round(rnd.lognormvariate(-1.5, 1), 3))
+    for _ in range(num_requests - num_requests // 2):
+        url = f'/cold/{rnd.randrange(num_urls)}'
+        table.setdefault(url, array('d')).append(round(rnd.lognormvariate(-1.5, 1), 3))
+    return table
+
+
+def bench(name, median, table):
+    started = time.perf_counter()
+    medians = {url: median(values) for url, values in table.items()}
+    elapsed = time.perf_counter() - started
+    print(f'{name:>24}: {elapsed:.3f}s')
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Median computation benchmark')
+    parser.add_argument('--requests', type=int, default=200000)
+    parser.add_argument('--urls', type=int, default=1000)
+    args = parser.parse_args()
+
+    table = generate_skewed_table(args.requests, args.urls)
+    print(f'{args.requests} requests, {len(table)} urls, hot url holds {len(table["/hot"])} requests')
+
+    before = bench('running_median_insort', lambda values: running_median_insort(values, len(values))[-1], table)
+    after = bench('select_kth', lambda values: select_kth(values, len(values) // 2), table)
+    assert before == after, 'medians differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Скорость разбора строк лога: прежнее регулярное выражение из parse_report против
+parse_request_line, в строках в секунду.
+
+    python benchmarks/bench_parser.py --lines 500000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_analyzer import parse_request_line  # noqa: E402
+
+LINE_TEMPLATE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+                 '"Mozilla/5.0 (Windows; U; Windows NT 6.0; ru; rv:1.9.0.12) Gecko/2009070611 Firefox/3.0.12 '
+                 '(.NET CLR 3.5.30729)" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {request_time:.3f}\n')
+
+
+def generate_lines(num_lines, seed=42):
+    rnd = random.Random(seed)
+    return [LINE_TEMPLATE.format(url=f'/api/v2/banner/{rnd.randrange(100000)}',
+                                 request_time=rnd.lognormvariate(-1.5, 1)).encode()
+            for _ in range(num_lines)]
+
+
+def parse_with_regex(lines):
+    parsed = 0
+    for line in lines:
+        match = re.search(r"(?P<path>\S+) HTTP\/1\.\d\".*\"(?P<request_time>.*)", line.decode('utf-8'))
+        if match:
+            match.group(1)
+            float(match.group(2).strip())
+            parsed += 1
+    return parsed
+
+
+def parse_with_parse_request_line(lines):
+    parsed = 0
+    for line in lines:
+        if parse_request_line(line, 0, len(line)) is not None:
+            parsed += 1
+    return parsed
+
+
+def bench(name, parse, lines):
+    started = time.perf_counter()
+    parsed = parse(lines)
+    elapsed = time.perf_counter() - started
+    print(f'{name:>24}: {len(lines) / elapsed:12,.0f} lines/s')
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Log line parser benchmark')
+    parser.add_argument('--lines', type=int, default=500000)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines)
+    before = bench('re.search', parse_with_regex, lines)
+    after = bench('parse_request_line', parse_with_parse_request_line, lines)
+    assert before == after, 'parsed line counts differ'
+
+
+if __name__ == '__main__':
+    main()
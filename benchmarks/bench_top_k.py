@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+calculate_metrics на таблице с большим числом различных url: прежний вариант (строка отчёта
+для каждого url, полная сортировка, срез) против отбора REPORT_SIZE url кучей.
+
+    python benchmarks/bench_top_k.py --urls 1000000
+    python benchmarks/bench_top_k.py --urls 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_analyzer import UrlTable, calculate_metrics  # noqa: E402
+
+
+def calculate_metrics_full_sort(table_collection, size=1000):
+    """Реализация calculate_metrics до перехода на отбор кучей"""
+    table_list = list()
+    table = table_collection['table']
+
+    round_prec = 3
+    for url_id, path in enumerate(table.urls):
+        ct = table.counts[url_id]
+        time_sum = round(table.time_sum(url_id), round_prec)
+        time_avg = round(table.time_sum(url_id) / ct, round_prec)
+        count_perc = round(ct * 100 / table_collection['own_num_request'], round_prec)
+        time_perc = round(time_sum * 100 / table_collection['own_sum_request_time'], round_prec)
+        time_max = round(table.time_maxes[url_id], round_prec)
+        table_list.append({'url': path.decode('utf-8', errors='replace'),
+                           'count': ct,
+                           'time_sum': time_sum,
+                           'time_avg': time_avg,
+                           'count_perc': count_perc,
+                           'time_perc': time_perc,
+                           'time_max': time_max,
+                           'time_med': round(table.quantile(url_id, 0.5), round_prec)})
+
+    table_list.sort(key=lambda el: el['time_sum'], reverse=True)
+    return table_list[0:size]
+
+
+def generate_table(num_urls, seed=42):
+    rnd = random.Random(seed)
+    table = UrlTable()
+    own_num_request = own_sum_request_time = 0
+    for number in range(num_urls):
+        url_id = table.intern(f'/api/v2/banner/{number}'.encode())
+        for _ in range(int(rnd.paretovariate(2))):
+            request_time = round(rnd.lognormvariate(-1.5, 1), 3)
+            table.add(url_id, request_time, round(request_time * 1000000))
+            own_num_request += 1
+            own_sum_request_time += request_time
+    return {'table': table, 'own_num_request': own_num_request, 'own_sum_request_time': own_sum_request_time}
+
+
+def bench(name, calculate, table_dict, size):
+    started = time.perf_counter()
+    table = calculate(table_dict, size=size)
+    elapsed = time.perf_counter() - started
+    print(f'{name:>28}: {elapsed:.3f}s')
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='calculate_metrics top-K benchmark')
+    parser.add_argument('--urls', type=int, default=1000000)
+    parser.add_argument('--size', type=int, default=1000, help='REPORT_SIZE')
+    args = parser.parse_args()
+
+    table_dict = generate_table(args.urls)
+    print(f'{args.urls} distinct urls, REPORT_SIZE={args.size}')
+
+    before = bench('full sort', calculate_metrics_full_sort, table_dict, args.size)
+    after = bench('heap top-K', calculate_metrics, table_dict, args.size)
+    assert [row['time_sum'] for row in before] == [row['time_sum'] for row in after], 'reports differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Детерминированный генератор логов nginx в формате ui_short для бенчмарков.
+
+    python -m benchmarks.generator ./log/nginx-access-ui.log-20170630 --lines 1000000 --urls 100000
+"""
+import argparse
+import bisect
+import datetime
+import gzip
+import itertools
+import random
+
+LINE_TEMPLATE = ('{ip} -  - [{time_local}] "{method} {url} HTTP/1.1" 200 {body_bytes} "-" "{user_agent}" "-" '
+                 '"{request_id}" "{user}" {request_time:.3f}\n')
+
+URL_TEMPLATES = [
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/v2/slot/{id}/groups',
+    '/api/v2/internal/banner/{id}/info',
+    '/api/1/photogenic_banners/list/?server_name=WIN{id}',
+    '/export/appinstall_raw/2017-06-{id}/',
+]
+
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Python-urllib/2.7',
+    'python-requests/2.13.0',
+    'Mozilla/5.0 (Windows; U; Windows NT 6.0; ru; rv:1.9.0.12) Gecko/2009070611 Firefox/3.0.12 (.NET CLR 3.5.30729)',
+]
+
+LATENCY_DISTRIBUTIONS = ('lognormal', 'exponential', 'uniform')
+
+
+def make_urls(num_urls):
+    return [URL_TEMPLATES[number % len(URL_TEMPLATES)].format(id=number) for number in range(num_urls)]
+
+
+def make_zipf_cum_weights(num_urls, skew):
+    """
+    Накопленные веса распределения Ципфа: url с рангом r встречается с вероятностью ~ 1 / r ** skew
+    """
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, num_urls + 1)))
+
+
+def make_request_time(rnd, distribution, scale):
+    if distribution == 'lognormal':
+        return rnd.lognormvariate(-2, 1) * scale
+    if distribution == 'exponential':
+        return rnd.expovariate(10) * scale
+    if distribution == 'uniform':
+        return rnd.uniform(0, 0.2) * scale
+    raise ValueError(f"Unknown latency distribution: {distribution}")
+
+
+def iter_log_lines(lines=100000, urls=10000, skew=1.1, latency='lognormal', broken_ratio=0.0, seed=42,
+                   date=datetime.date(2017, 6, 29)):
+    """
+    Генерирует строки лога. Одинаковые параметры всегда дают одинаковый лог.
+    :param lines: количество строк
+    :param urls: количество различных url
+    :param skew: показатель распределения Ципфа для популярности url, 0 - равномерное
+    :param latency: распределение $request_time: lognormal, exponential или uniform
+    :param broken_ratio: доля строк, которые не должны разбираться
+    :param seed:
+    :param date: дата в $time_local, запросы равномерно распределены по суткам
+    :return:
+    """
+    if latency not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution: {latency}")
+    rnd = random.Random(seed)
+    url_list = make_urls(urls)
+    # у каждого url свой множитель задержки, чтобы в отчёте были медленные и быстрые url
+    scales = [0.5 + rnd.random() * 4 for _ in range(urls)]
+    cum_weights = make_zipf_cum_weights(urls, skew)
+    total_weight = cum_weights[-1]
+    start = datetime.datetime.combine(date, datetime.time())
+
+    for number in range(lines):
+        if broken_ratio and rnd.random() < broken_ratio:
+            yield f'broken line {number} "without request" -\n'
+            continue
+        url_number = min(bisect.bisect(cum_weights, rnd.random() * total_weight), urls - 1)
+        time_local = start + datetime.timedelta(seconds=86400 * number // lines)
+        yield LINE_TEMPLATE.format(ip=f'1.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}',
+                                   time_local=f'{time_local:%d/%b/%Y:%H:%M:%S} +0300',
+                                   method='GET',
+                                   url=url_list[url_number],
+                                   body_bytes=rnd.randrange(20, 30000),
+                                   user_agent=USER_AGENTS[url_number % len(USER_AGENTS)],
+                                   request_id=f'{1498697422 + number}-{rnd.randrange(10 ** 10)}-4708-{number}',
+                                   user='-' if url_number % 3 else f'{url_number:x}',
+                                   request_time=make_request_time(rnd, latency, scales[url_number]))
+
+
+def generate_log(path_to_log_file, is_gzip=False, **params):
+    """
+    Записывает сгенерированный лог в файл
+    :param path_to_log_file:
+    :param is_gzip: сжать gzip
+    :param params: параметры iter_log_lines
+    :return: path_to_log_file
+    """
+    opener = gzip.open if is_gzip else open
+    with opener(path_to_log_file, 'wt') as f_in:
+        f_in.writelines(iter_log_lines(**params))
+    return path_to_log_file
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--lines', type=int, default=100000, help='number of log lines')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct urls')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of url popularity')
+    parser.add_argument('--latency', choices=LATENCY_DISTRIBUTIONS, default='lognormal',
+                        help='request time distribution')
+    parser.add_argument('--broken-ratio', type=float, default=0.0, help='ratio of unparsable lines')
+    parser.add_argument('--gzip', action='store_true', help='compress the log with gzip')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser
+
+
+def get_generator_params(args):
+    return {'lines': args.lines, 'urls': args.urls, 'skew': args.skew, 'latency': args.latency,
+            'broken_ratio': args.broken_ratio, 'seed': args.seed}
+
+
+def main():
+    parser = add_generator_arguments(argparse.ArgumentParser(description='Synthetic nginx log generator'))
+    parser.add_argument('path', type=str, help='path to the generated log')
+    args = parser.parse_args()
+    generate_log(args.path, is_gzip=args.gzip, **get_generator_params(args))
+
+
+if __name__ == '__main__':
+    main()
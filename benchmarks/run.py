@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк стадий анализатора на синтетическом логе: разбор (parse_report), расчёт метрик
+(calculate_metrics), рендеринг (render) и полное время построения отчёта. Для каждой стадии
+пишется время, пропускная способность в строках в секунду и пиковый RSS самой стадии (на Linux
+пик сбрасывается перед каждой стадией, иначе у всех стадий после разбора был бы пик разбора;
+где сброс не поддерживается, пиковый RSS пишется только для time_to_report). Каждый
+сценарий (несжатый и gzip лог) выполняется в отдельном процессе, чтобы RSS не смешивался.
+
+    python -m benchmarks.run --lines 1000000 --output bench.json
+    python -m benchmarks.run --lines 1000000 --baseline bench.json --tolerance 0.2
+
+С --baseline сравнивает результат с прошлым запуском и завершается с кодом 1, если какая-то
+метрика ухудшилась больше чем на tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks.generator import add_generator_arguments, generate_log, get_generator_params
+from log_analyzer import calculate_metrics, parse_report, render
+
+# метрики, для которых больше - лучше; для остальных (время, память) лучше меньше
+HIGHER_IS_BETTER = {'lines_per_second'}
+
+PATH_TO_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates', 'report.html')
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return round(peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def reset_peak_rss():
+    """
+    Сбрасывает пиковый RSS процесса (VmHWM), чтобы следующая стадия мерила свой пик, а не пик
+    предыдущих стадий. Работает только на Linux: запись 5 в /proc/self/clear_refs.
+    :return: True, если пик сброшен
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f_in:
+            f_in.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def get_stage_peak_rss_mb():
+    """
+    Пиковый RSS с последнего reset_peak_rss
+    """
+    with open('/proc/self/status') as f_out:
+        for line in f_out:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def measure(stage, results, num_lines, func, *args, **kwargs):
+    is_reset = reset_peak_rss()
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    results[stage] = {'seconds': round(elapsed, 4),
+                      'lines_per_second': round(num_lines / elapsed) if elapsed else None,
+                      'peak_rss_mb': get_stage_peak_rss_mb() if is_reset else None}
+    return result
+
+
+def run_scenario(path_to_log_file, num_lines, report_dir, size=1000, workers=1):
+    """
+    Прогоняет все стадии на одном логе
+    :return: словарь стадия -> метрики
+    """
+    results = {}
+    started = time.perf_counter()
+    table_dict = measure('parse', results, num_lines, parse_report, path_to_log_file, error_threshold_perc=100,
+                         workers=workers)
+    table = measure('calculate_metrics', results, num_lines, calculate_metrics, table_dict, size=size)
+    measure('render', results, num_lines, lambda: render(json.dumps(table), 'report.html', report_dir,
+                                                         PATH_TO_TEMPLATE))
+    elapsed = time.perf_counter() - started
+    # сброс пика обнуляет и ru_maxrss, поэтому пик всего построения - максимум пиков стадий
+    stage_peaks = [results[stage]['peak_rss_mb'] for stage in ('parse', 'calculate_metrics', 'render')]
+    results['time_to_report'] = {'seconds': round(elapsed, 4), 'lines_per_second': round(num_lines / elapsed),
+                                 'peak_rss_mb': max(stage_peaks) if None not in stage_peaks else get_peak_rss_mb()}
+    results['distinct_urls'] = len(table_dict['table'])
+    return results
+
+
+def compare_results(current, baseline, tolerance=0.1):
+    """
+    Сравнивает результаты двух запусков
+    :param current:
+    :param baseline:
+    :param tolerance: допустимое относительное ухудшение
+    :return: список описаний регрессий
+    """
+    regressions = []
+    for scenario, stages in baseline['results'].items():
+        for stage, metrics in stages.items():
+            if not isinstance(metrics, dict):
+                continue
+            for metric, baseline_value in metrics.items():
+                value = current['results'].get(scenario, {}).get(stage, {}).get(metric)
+                if not baseline_value or value is None:
+                    continue
+                if metric in HIGHER_IS_BETTER:
+                    regressed = value < baseline_value * (1 - tolerance)
+                else:
+                    regressed = value > baseline_value * (1 + tolerance)
+                if regressed:
+                    regressions.append(f'{scenario}.{stage}.{metric}: {baseline_value} -> {value}')
+    return regressions
+
+
+def main():
+    parser = add_generator_arguments(argparse.ArgumentParser(description='Log analyzer benchmark suite'))
+    parser.add_argument('--size', type=int, default=1000, help='REPORT_SIZE')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes for parse_report')
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args()
+
+    params = get_generator_params(args)
+    output = {'params': {**params, 'size': args.size, 'workers': args.workers},
+              'python': platform.python_version(),
+              'results': {}}
+    with tempfile.TemporaryDirectory() as path_to_temp:
+        scenarios = ['gzip'] if args.gzip else ['plain', 'gzip']
+        for scenario in scenarios:
+            path_to_log_file = os.path.join(path_to_temp, 'nginx-access-ui.log-20170629')
+            if scenario == 'gzip':
+                path_to_log_file += '.gz'
+            generate_log(path_to_log_file, is_gzip=scenario == 'gzip', **params)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                output['results'][scenario] = executor.submit(run_scenario, path_to_log_file, args.lines,
+                                                              os.path.join(path_to_temp, 'reports'),
+                                                              args.size, args.workers).result()
+            os.remove(path_to_log_file)
+
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f_in:
+            json.dump(output, f_in, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f_out:
+            regressions = compare_results(output, json.load(f_out), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,24 +7,230 @@
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
 import argparse
+import cProfile
 import datetime
 import gzip
+import heapq
 import json
 import logging
+import math
+import mmap
 import os
+import pickle
+import random
 import re
+import struct
 import sys
-from bisect import insort, bisect_left
-from collections import deque, defaultdict
-from itertools import islice
+import time
+import tracemalloc
+import zlib
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
 from string import Template
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "EXACT_METRICS": False,
+    "WORKERS": 1,
+    "SNAPSHOT_DIR": "./snapshots",
+    "FOLLOW_LOG": "nginx-access-ui.log",
+    "FOLLOW_INTERVAL": 60,
+    "URL_STRIP_QUERY": False,
+    "URL_REPLACE_IDS": False,
+    "URL_REWRITE_RULES": [],
+    "URL_CACHE_SIZE": 100000,
+    "MAX_URLS": None,
+    "BATCH_CONCURRENCY": None,
+    "BATCH_WORKER_MEMORY_MB": None,
+    "METRICS_FILE": None,
+    "REPORT_DATA_FILE": False,
+    "EXPORT_FORMAT": None,
+    "TIME_BUCKET_MINUTES": None,
+    "LOG_DIR_INDEX": None,
+    "SAMPLE_RATE": None,
+    "SAMPLE_HEAVY_HITTERS": 0
 }
 
+GZIP_INDEX_VERSION = 1
+LOG_DIR_INDEX_VERSION = 2
+# индексу директории логов не верим, если она менялась меньше чем за столько секунд до его записи
+LOG_DIR_INDEX_RACY_SECONDS = 5
+LOG_FILE_PATTERN = re.compile(r"nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$")
+READ_BLOCK_SIZE = 1 << 20
+SAMPLE_BLOCK_SIZE = 1 << 16
+
+# квантиль нормального распределения для 95% доверительных интервалов приближённого режима
+CONFIDENCE_Z = 1.96
+
+# url, в который сворачиваются все url сверх MAX_URLS
+OTHER_URL = b'<other>'
+
+# во время разбора таблица url ограничивается MAX_URLS_HIGH_WATER * MAX_URLS строками
+MAX_URLS_HIGH_WATER = 2
+
+# номера месяцев в $time_local
+MONTHS = {month.encode(): number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+SNAPSHOT_MAGIC = b'LOGASNAP'
+SNAPSHOT_VERSION = 4
+
+# относительная погрешность квантилей, которые считаются по гистограмме LatencyHistogram
+HISTOGRAM_ACCURACY = 0.01
+
+
+class StageMetrics:
+    """
+    Собирает метрики стадий анализатора: время (wall и CPU, включая дочерние процессы), прочитанные
+    байты, строки, пиковую память процесса и число различных url. Время вложенной стадии
+    не входит во время внешней, поэтому, например, распаковка gzip ('read') учитывается отдельно
+    от разбора строк ('parse').
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+
+    def reset(self):
+        self.stages = {}
+        self._stack = []
+
+    @staticmethod
+    def _cpu_time():
+        cpu_time = time.process_time()
+        if resource is not None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_time += children.ru_utime + children.ru_stime
+        return cpu_time
+
+    @staticmethod
+    def _peak_rss():
+        if resource is None:
+            return None
+        usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+    def _add(self, name, wall, cpu, **values):
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0, 'lines': 0,
+                                              'distinct_urls': 0, 'peak_rss_bytes': None})
+        stage['wall_seconds'] += wall
+        stage['cpu_seconds'] += cpu
+        for key, value in values.items():
+            if key in ('bytes', 'lines'):
+                stage[key] += value
+            else:
+                stage[key] = value
+        stage['peak_rss_bytes'] = self._peak_rss()
+        if self._stack:
+            self._stack[-1]['nested_wall'] += wall
+            self._stack[-1]['nested_cpu'] += cpu
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Замеряет стадию; в возвращаемый словарь можно записать bytes, lines и distinct_urls
+        """
+        values = {}
+        frame = {'nested_wall': 0.0, 'nested_cpu': 0.0}
+        self._stack.append(frame)
+        started_wall, started_cpu = time.perf_counter(), self._cpu_time()
+        try:
+            yield values
+        finally:
+            self._stack.pop()
+            self._add(name,
+                      time.perf_counter() - started_wall - frame['nested_wall'],
+                      self._cpu_time() - started_cpu - frame['nested_cpu'],
+                      **values)
+
+    def iter_blocks(self, name, blocks):
+        """
+        Пропускает через себя поток блоков bytes, относя время их получения и размер к стадии name
+        """
+        blocks = iter(blocks)
+        while True:
+            started_wall, started_cpu = time.perf_counter(), time.process_time()
+            block = next(blocks, None)
+            self._add(name, time.perf_counter() - started_wall, time.process_time() - started_cpu,
+                      bytes=len(block) if block is not None else 0)
+            if block is None:
+                return
+            yield block
+
+    def merge(self, stages):
+        """
+        Добавляет метрики стадий другого процесса (например, процесса пакетного режима):
+        время, байты и строки суммируются, для памяти и числа url берётся максимум
+        :param stages: словарь stages другого StageMetrics
+        """
+        for name, other in stages.items():
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = dict(other)
+                continue
+            for key in ('wall_seconds', 'cpu_seconds', 'bytes', 'lines'):
+                stage[key] += other[key]
+            for key in ('distinct_urls', 'peak_rss_bytes'):
+                values = [value for value in (stage[key], other[key]) if value is not None]
+                stage[key] = max(values) if values else None
+
+    def summary(self):
+        lines = []
+        for name, stage in self.stages.items():
+            lines_per_second = stage['lines'] / stage['wall_seconds'] if stage['lines'] and stage['wall_seconds'] else 0
+            peak_rss_mb = stage['peak_rss_bytes'] / 1024 / 1024 if stage['peak_rss_bytes'] else 0
+            lines.append(f"{name}: wall {stage['wall_seconds']:.3f}s, cpu {stage['cpu_seconds']:.3f}s, "
+                         f"{stage['bytes']} bytes, {stage['lines']} lines, {lines_per_second:.0f} lines/s, "
+                         f"peak memory {peak_rss_mb:.1f} MB, {stage['distinct_urls']} urls")
+        return "\n".join(lines)
+
+    def write_prometheus(self, path_to_metrics_file):
+        """
+        Записывает метрики в текстовом формате Prometheus для textfile collector node exporter
+        (атомарно, через временный файл)
+        """
+        metrics = [('wall_seconds', 'Wall time of the stage'),
+                   ('cpu_seconds', 'CPU time of the stage including child processes'),
+                   ('bytes', 'Bytes read during the stage'),
+                   ('lines', 'Log lines processed during the stage'),
+                   ('distinct_urls', 'Distinct urls after the stage'),
+                   ('peak_rss_bytes', 'Peak resident memory of the analyzer at the end of the stage')]
+        rows = []
+        for metric, description in metrics:
+            rows.append(f"# HELP log_analyzer_stage_{metric} {description}")
+            rows.append(f"# TYPE log_analyzer_stage_{metric} gauge")
+            for name, stage in self.stages.items():
+                if stage[metric] is not None:
+                    rows.append(f'log_analyzer_stage_{metric}{{stage="{name}"}} {stage[metric]}')
+        write_atomic(path_to_metrics_file, lambda f_in: f_in.write("\n".join(rows) + "\n"))
+
+
+stage_metrics = StageMetrics()
+
 
 def load_config(path_to_file: str) -> dict:
     """
@@ -45,72 +251,666 @@ def load_config(path_to_file: str) -> dict:
     return loaded_config
 
 
-def extract_date_frome_file_name(file_name):
-    pattern = r"nginx-access-ui.log-(?P<date>\d{8})(.gz)?"
-    match = re.match(pattern, file_name)
+@lru_cache(maxsize=4096)
+def parse_log_date(file_name):
+    """
+    Возвращает дату из имени файла лога или None, если это не файл лога
+    :raises ValueError: в имени лога несуществующая дата, например nginx-access-ui.log-20171399
+    """
+    match = LOG_FILE_PATTERN.match(file_name)
     if match:
-        date_group = match.group(1)
-        try:
-            return datetime.datetime.strptime(date_group, "%Y%m%d").date()
-        except ValueError as e:
-            logging.error(e)
-            sys.exit(f"Incorrect date format in name of file '{file_name}', it must be %Y%m%d")
+        date_group = match.group('date')
+        return datetime.date(int(date_group[:4]), int(date_group[4:6]), int(date_group[6:]))
 
     return None
 
 
-def get_last_log_file(path_to_log_dir):
+def extract_date_frome_file_name(file_name):
+    try:
+        return parse_log_date(file_name)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(f"Incorrect date format in name of file '{file_name}', it must be %Y%m%d")
+
+
+def scan_log_dir(path_to_log_dir, path_to_index=None):
     """
-    Возвращает путь к самому свежему файлу лога из переданной директории path_to_log_dir, фильтрует
-    файлы согласно паттерну ниже.
+    Находит файлы логов за один проход os.scandir, без stat каждого файла; остальные файлы
+    пропускаются. С path_to_index список логов сохраняется в JSON-индекс и берётся из него,
+    пока не изменилось время изменения директории (оно меняется при создании, удалении
+    и переименовании файлов), так что на медленной файловой системе директория не читается заново.
+    Индекс, записанный меньше чем через LOG_DIR_INDEX_RACY_SECONDS после изменения директории, не используется:
+    на сетевых файловых системах время изменения грубое, и новый лог могло не сдвинуть его.
     :param path_to_log_dir:
-    :return:
+    :param path_to_index: путь к индексу, None - без индекса
+    :return: список пар (дата, имя файла)
     """
-    if not os.path.exists(path_to_log_dir):
+    try:
+        dir_mtime = os.stat(path_to_log_dir).st_mtime_ns
+    except FileNotFoundError:
         error_message = f"Directory with logs does not exist: {path_to_log_dir}"
         logging.error(error_message)
         sys.exit(error_message)
-    fresh_file_name = sorted(os.listdir(path_to_log_dir), key=lambda name: extract_date_frome_file_name(name), reverse=True)[0]
+
+    if path_to_index is not None:
+        try:
+            with open(path_to_index, 'r') as f_out:
+                index = json.load(f_out)
+            if index['version'] == LOG_DIR_INDEX_VERSION and index['dir'] == path_to_log_dir \
+                    and index['mtime'] == dir_mtime:
+                # как racy-index в git: файл, созданный в тот же тик времени изменения директории,
+                # что и индекс, это время не изменит, поэтому такому индексу верить нельзя
+                if index['written'] - dir_mtime >= LOG_DIR_INDEX_RACY_SECONDS * 1000000000:
+                    return [(datetime.date.fromordinal(ordinal), name) for ordinal, name in index['logs']]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    logs = []
+    with os.scandir(path_to_log_dir) as entries:
+        for entry in entries:
+            try:
+                date = parse_log_date(entry.name)
+            except ValueError as e:
+                # один файл с неверной датой не должен мешать обработке остальных логов
+                logging.warning(f"Skipping {entry.name}: incorrect date in the file name ({e})")
+                continue
+            if date is not None:
+                logs.append((date, entry.name))
+
+    if path_to_index is not None:
+        index = {'version': LOG_DIR_INDEX_VERSION, 'dir': path_to_log_dir, 'mtime': dir_mtime,
+                 'written': time.time_ns(), 'logs': [(date.toordinal(), name) for date, name in logs]}
+        try:
+            write_atomic(path_to_index, lambda f_in: json.dump(index, f_in))
+        except OSError as e:
+            logging.warning(f"Unable to save log directory index {path_to_index}: {e.strerror}")
+    return logs
+
+
+def get_last_log_file(path_to_log_dir, path_to_index=None):
+    """
+    Возвращает путь к самому свежему файлу лога из переданной директории path_to_log_dir: максимум
+    за один проход, без сортировки. Если за дату есть и несжатый, и .gz файл, берётся несжатый.
+    :param path_to_log_dir:
+    :param path_to_index: индекс scan_log_dir, None - без индекса
+    :return:
+    """
+    fresh_key = fresh_file_name = None
+    for date, name in scan_log_dir(path_to_log_dir, path_to_index):
+        key = (date, not name.endswith('.gz'))
+        if fresh_key is None or key > fresh_key:
+            fresh_key, fresh_file_name = key, name
+    if fresh_file_name is None:
+        error_message = f"There are no logs in {path_to_log_dir}"
+        logging.error(error_message)
+        sys.exit(error_message)
     return os.path.join(path_to_log_dir, fresh_file_name)
 
 
-def render(table_json: str, report_name: str, report_dir: str, path_to_template="./templates/report.html"):
+def get_log_files(path_to_log_dir, date_from=None, date_to=None, path_to_index=None):
+    """
+    Возвращает пути к файлам логов из директории path_to_log_dir за период [date_from, date_to],
+    отсортированные по дате; если за дату есть и несжатый, и .gz файл, берётся несжатый.
+    :param path_to_log_dir:
+    :param date_from: None - без ограничения
+    :param date_to: None - без ограничения
+    :param path_to_index: индекс scan_log_dir, None - без индекса
+    :return: список пар (дата, путь к файлу)
+    """
+    log_files = {}
+    for date, name in scan_log_dir(path_to_log_dir, path_to_index):
+        if (date_from is not None and date < date_from) or (date_to is not None and date > date_to):
+            continue
+        if date not in log_files or log_files[date].endswith('.gz'):
+            log_files[date] = name
+    return sorted((date, os.path.join(path_to_log_dir, name)) for date, name in log_files.items())
+
+
+@lru_cache(maxsize=8)
+def load_template(path_to_template, mtime_ns=None):
+    """
+    Читает шаблон отчёта и делит его по $table_json на начало и конец, чтобы строки таблицы
+    писались между ними, не попадая в Template. Результат кешируется по пути и времени изменения шаблона.
+    :param path_to_template:
+    :param mtime_ns: время изменения шаблона, ключ кеша
+    :return: (Template начала, Template конца)
+    """
+    with open(path_to_template, "r") as f_out:
+        html_template = f_out.read()
+    for match in Template.pattern.finditer(html_template):
+        if 'table_json' in (match.group('named'), match.group('braced')):
+            return Template(html_template[:match.start()]), Template(html_template[match.end():])
+    return Template(html_template), Template('')
+
+
+def write_table_json(f_in, table):
+    """
+    Пишет строки отчёта JSON-массивом по одной строке за раз, не собирая весь JSON в памяти.
+    Строка (уже сериализованный JSON) пишется как есть.
+    :param f_in:
+    :param table: список строк отчёта или JSON-строка
+    :return:
+    """
+    if isinstance(table, str):
+        f_in.write(table)
+        return
+    encoder = json.JSONEncoder()
+    f_in.write('[')
+    for number, row in enumerate(table):
+        if number:
+            f_in.write(', ')
+        for chunk in encoder.iterencode(row):
+            f_in.write(chunk)
+    f_in.write(']')
+
+
+def write_atomic(path, write, mode="w"):
+    """
+    Пишет файл во временный файл рядом и переименовывает, чтобы не оставить недописанный файл
+    :param path:
+    :param write: функция, получающая открытый на запись файл
+    :param mode: режим открытия, "wb" для двоичных файлов
+    :return:
+    """
+    path_to_temp_file = f"{path}.{os.getpid()}.tmp"
     try:
-        with open(path_to_template, "r") as f_out:
-            html_template = f_out.read()
+        with open(path_to_temp_file, mode) as f_in:
+            write(f_in)
+        os.replace(path_to_temp_file, path)
+    except BaseException:
+        if os.path.exists(path_to_temp_file):
+            os.remove(path_to_temp_file)
+        raise
 
-            if not os.path.exists(report_dir):
-                os.makedirs(report_dir)
 
-            path_to_report_file = os.path.join(report_dir, report_name)
-            try:
-                with open(path_to_report_file, "w") as f_in:
-                    f_in.write(Template(html_template).safe_substitute(table_json=table_json))
-            except FileNotFoundError as e:
-                logging.error(e)
-                sys.exit(f"Wrong path to report file: {path_to_report_file} ({e.strerror})")
+def render(table, report_name: str, report_dir: str, path_to_template="./templates/report.html", data_file=False):
+    """
+    Записывает отчёт потоково: начало шаблона, строки таблицы, конец шаблона
+    :param table: список строк отчёта или уже сериализованный JSON
+    :param report_name:
+    :param report_dir:
+    :param path_to_template:
+    :param data_file: писать строки в отдельный <отчёт>.json, который страница загружает сама
+    :return:
+    """
+    try:
+        header, footer = load_template(path_to_template, os.stat(path_to_template).st_mtime_ns)
     except FileNotFoundError as e:
         sys.exit(f"Wrong path to template: {path_to_template} ({e.strerror})")
 
+    os.makedirs(report_dir, exist_ok=True)
+    path_to_report_file = os.path.join(report_dir, report_name)
 
-def running_median_insort(seq, window_size=1000):
-    """Contributed by Peter Otten"""
-    seq = iter(seq)
-    d = deque()
-    s = []
-    result = []
-    for item in islice(seq, window_size):
-        d.append(item)
-        insort(s, item)
-        result.append(s[len(d) // 2])
-    m = window_size // 2
-    for item in seq:
-        old = d.popleft()
-        d.append(item)
-        del s[bisect_left(s, old)]
-        insort(s, item)
-        result.append(s[m])
-    return result
+    data_name = f"{os.path.splitext(report_name)[0]}.json" if data_file else None
+    variables = {'table_data_url': json.dumps(data_name)}
+
+    def write_report(f_in):
+        f_in.write(header.safe_substitute(variables))
+        # при data_file страница загрузит строки из data_name сама
+        write_table_json(f_in, 'null' if data_file else table)
+        f_in.write(footer.safe_substitute(variables))
+
+    try:
+        if data_file:
+            # данные пишутся раньше отчёта, который на них ссылается
+            write_atomic(os.path.join(report_dir, data_name), lambda f_in: write_table_json(f_in, table))
+        write_atomic(path_to_report_file, write_report)
+    except FileNotFoundError as e:
+        logging.error(e)
+        sys.exit(f"Wrong path to report file: {path_to_report_file} ({e.strerror})")
+
+
+def select_kth(values, k):
+    """
+    Возвращает k-й по возрастанию элемент values (с нуля) за O(n) в среднем, без полной сортировки:
+    numpy.partition, если доступен numpy, иначе quickselect на чистом Python.
+    :param values: array('d') или последовательность чисел
+    :param k:
+    :return:
+    """
+    if numpy is not None:
+        buffer = numpy.frombuffer(values, dtype=numpy.float64) if isinstance(values, array) \
+            else numpy.asarray(values, dtype=numpy.float64)
+        return float(numpy.partition(buffer, k)[k])
+
+    values = list(values)
+    while True:
+        pivot = values[random.randrange(len(values))]
+        lows = [value for value in values if value < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        k -= len(lows)
+        pivots_count = values.count(pivot)
+        if k < pivots_count:
+            return pivot
+        k -= pivots_count
+        values = [value for value in values if value > pivot]
+
+
+class LatencyHistogram:
+    """
+    Сжатое представление распределения $request_time одного url: логарифмические корзины,
+    каждая из которых хранит только количество попавших в неё значений. Относительная
+    погрешность квантилей не превышает HISTOGRAM_ACCURACY, а размер ограничен числом корзин
+    (не более нескольких тысяч), а не числом запросов. Гистограммы можно сливать.
+    """
+    __slots__ = ('buckets',)
+
+    gamma = (1 + HISTOGRAM_ACCURACY) / (1 - HISTOGRAM_ACCURACY)
+    inv_log_gamma = 1 / math.log(gamma)
+    zero_key = -2 ** 31  # корзина для нулевого $request_time
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, value):
+        key = math.ceil(math.log(value) * self.inv_log_gamma) if value > 0 else self.zero_key
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        buckets = self.buckets
+        for key, count in other.buckets.items():
+            buckets[key] = buckets.get(key, 0) + count
+
+    def quantile(self, q, count):
+        """
+        Возвращает значение, которое стоит на позиции int(count * q) в отсортированной выборке
+        :param q: квантиль от 0 до 1
+        :param count: количество значений в гистограмме
+        :return:
+        """
+        rank = min(int(count * q), count - 1)
+        for key in sorted(self.buckets):
+            rank -= self.buckets[key]
+            if rank < 0:
+                break
+        if key == self.zero_key:
+            return 0.0
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def sum_of_squares(self):
+        """
+        Сумма квадратов значений по серединам корзин (относительная погрешность - 2 * HISTOGRAM_ACCURACY)
+        """
+        return sum(count * (2 * self.gamma ** key / (self.gamma + 1)) ** 2
+                   for key, count in self.buckets.items() if key != self.zero_key)
+
+
+class ExactValues:
+    """
+    Точное представление распределения $request_time: хранит все значения в array('d').
+    Используется для небольших файлов и в тестах.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = array('d')
+
+    def add(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def quantile(self, q, count):
+        return select_kth(self.values, min(int(count * q), count - 1))
+
+    def sum_of_squares(self):
+        return math.fsum(value * value for value in self.values)
+
+
+class UrlTable:
+    """
+    Агрегаты $request_time по url. Каждый различный url один раз получает плотный целочисленный
+    идентификатор, а количество, сумма, максимум и скетч распределения хранятся в параллельных
+    колонках, проиндексированных этим идентификатором. Строки url нужны только для итоговых
+    строк отчёта. Скетч создаётся со второго запроса url: для url с одним запросом значение
+    уже лежит в колонке максимумов. Сумма хранится в целых микросекундах, чтобы результат
+    слияния не зависел от порядка.
+    """
+    __slots__ = ('exact', 'ids', 'urls', 'counts', 'time_sums_us', 'time_maxes', 'sketches')
+
+    def __init__(self, exact=False):
+        self.exact = exact
+        self.ids = {}  # url -> идентификатор
+        self.urls = []  # идентификатор -> url
+        self.counts = array('q')
+        self.time_sums_us = array('q')
+        self.time_maxes = array('d')
+        self.sketches = []  # идентификатор -> LatencyHistogram/ExactValues или None
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __contains__(self, url):
+        return url in self.ids
+
+    def intern(self, url):
+        """
+        Возвращает идентификатор url, заводя новый при необходимости
+        :param url:
+        :return:
+        """
+        url_id = self.ids.get(url)
+        if url_id is not None:
+            return url_id
+        url_id = self.ids[url] = len(self.urls)
+        self.urls.append(url)
+        self.counts.append(0)
+        self.time_sums_us.append(0)
+        self.time_maxes.append(0.0)
+        self.sketches.append(None)
+        return url_id
+
+    def _get_sketch(self, url_id):
+        sketch = self.sketches[url_id]
+        if sketch is None:
+            sketch = self.sketches[url_id] = ExactValues() if self.exact else LatencyHistogram()
+            sketch.add(self.time_maxes[url_id])
+        return sketch
+
+    def add(self, url_id, request_time, request_time_us):
+        """
+        :param url_id: результат intern
+        :param request_time: $request_time в секундах
+        :param request_time_us: $request_time в целых микросекундах
+        :return:
+        """
+        count = self.counts[url_id]
+        if count:
+            self._get_sketch(url_id).add(request_time)
+            if request_time > self.time_maxes[url_id]:
+                self.time_maxes[url_id] = request_time
+        else:
+            self.time_maxes[url_id] = request_time
+        self.counts[url_id] = count + 1
+        self.time_sums_us[url_id] += request_time_us
+
+    def merge(self, other, rename=None):
+        """
+        :param other: UrlTable
+        :param rename: функция, которая переводит ключ other в ключ этой таблицы
+        :return:
+        """
+        for other_id, url in enumerate(other.urls):
+            url_id = self.intern(url if rename is None else rename(url))
+            if self.counts[url_id]:
+                sketch = self._get_sketch(url_id)
+                if other.sketches[other_id] is None:
+                    sketch.add(other.time_maxes[other_id])
+                else:
+                    sketch.merge(other.sketches[other_id])
+                if other.time_maxes[other_id] > self.time_maxes[url_id]:
+                    self.time_maxes[url_id] = other.time_maxes[other_id]
+            else:
+                self.sketches[url_id] = other.sketches[other_id]
+                self.time_maxes[url_id] = other.time_maxes[other_id]
+            self.counts[url_id] += other.counts[other_id]
+            self.time_sums_us[url_id] += other.time_sums_us[other_id]
+
+    def fold(self, rename):
+        """
+        Возвращает новую таблицу, в которой ключи переведены функцией rename, а строки
+        с одинаковым новым ключом слиты
+        """
+        folded = UrlTable(self.exact)
+        folded.merge(self, rename=rename)
+        return folded
+
+    def cap(self, max_urls):
+        """
+        Оставляет max_urls url с наибольшим суммарным временем, остальные сворачивает в OTHER_URL.
+        Отбор идёт по итоговым суммам, поэтому не зависит ни от порядка строк, ни от деления на части.
+        :param max_urls:
+        :return: новая таблица или эта же, если url (кроме OTHER_URL) не больше max_urls
+        """
+        if len(self) - (OTHER_URL in self) <= max_urls:
+            return self
+        # при равных суммах решает сам url, чтобы отбор не зависел от порядка строк
+        kept = set(heapq.nlargest(max_urls, (url for url in self.urls if url != OTHER_URL),
+                                  key=lambda url: (self.time_sums_us[self.ids[url]], url)))
+        return self.fold(lambda url: url if url in kept else OTHER_URL)
+
+    def time_sum(self, url_id):
+        return self.time_sums_us[url_id] / 1000000
+
+    def quantile(self, url_id, q):
+        sketch = self.sketches[url_id]
+        if sketch is None:
+            return self.time_maxes[url_id]
+        return min(sketch.quantile(q, self.counts[url_id]), self.time_maxes[url_id])
+
+    def time_sq_sum(self, url_id):
+        """
+        Сумма квадратов $request_time url (для доверительных интервалов приближённого режима)
+        """
+        sketch = self.sketches[url_id]
+        if sketch is None:
+            return self.time_maxes[url_id] ** 2
+        return sketch.sum_of_squares()
+
+    def dump(self):
+        """
+        Возвращает состояние таблицы из примитивных типов (для снимков)
+        """
+        sketches = [None if sketch is None else sketch.values if self.exact else sketch.buckets
+                    for sketch in self.sketches]
+        return (self.exact, self.urls, self.counts.tobytes(), self.time_sums_us.tobytes(), self.time_maxes.tobytes(),
+                sketches)
+
+    @classmethod
+    def load(cls, state):
+        """
+        Восстанавливает таблицу из результата dump
+        :param state:
+        :return:
+        """
+        exact, urls, counts, time_sums_us, time_maxes, sketches = state
+        table = cls(exact)
+        table.urls = urls
+        table.ids = {url: url_id for url_id, url in enumerate(urls)}
+        table.counts.frombytes(counts)
+        table.time_sums_us.frombytes(time_sums_us)
+        table.time_maxes.frombytes(time_maxes)
+        for sketch_state in sketches:
+            sketch = None
+            if sketch_state is not None:
+                sketch = ExactValues() if exact else LatencyHistogram()
+                if exact:
+                    sketch.values = sketch_state
+                else:
+                    sketch.buckets = sketch_state
+            table.sketches.append(sketch)
+        return table
+
+
+class SpaceSaving:
+    """
+    Взвешенный алгоритм Space-Saving: находит url с наибольшим суммарным весом (здесь - $request_time
+    в микросекундах) в потоке, храня не более capacity счётчиков. Оценка веса url не меньше истинной
+    и превышает её не больше чем на error; любой url с весом больше минимального счётчика
+    гарантированно отслеживается. Счётчики хранятся в словаре, минимальный ищется по куче, записи
+    которой обновляются лениво: вес отслеживаемого url только растёт. Сводки можно сливать.
+    """
+    __slots__ = ('capacity', 'counters', 'heap')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # url -> [оценка веса, погрешность]
+        self.heap = []  # (вес на момент записи, url), по одной записи на url
+
+    def add(self, key, weight):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+            heapq.heappush(self.heap, (weight, key))
+        else:
+            min_weight = self.min_weight()
+            del self.counters[self.heap[0][1]]
+            self.counters[key] = [min_weight + weight, min_weight]
+            heapq.heapreplace(self.heap, (min_weight + weight, key))
+
+    def min_weight(self):
+        """
+        Минимальный счётчик (0, пока счётчиков меньше capacity): верхняя граница веса любого
+        неотслеживаемого url
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        heap = self.heap
+        while True:
+            weight, key = heap[0]
+            current = self.counters[key][0]
+            if current == weight:
+                return weight
+            heapq.heapreplace(heap, (current, key))
+
+    def merge(self, other):
+        """
+        Слияние сводок: отсутствующий в одной из сводок url получает её минимальный счётчик
+        как вес и погрешность, затем остаются capacity наибольших счётчиков
+        """
+        self_min, other_min = self.min_weight(), other.min_weight()
+        merged = {}
+        for key in self.counters.keys() | other.counters.keys():
+            weight, error = self.counters.get(key, (self_min, self_min))
+            other_weight, other_error = other.counters.get(key, (other_min, other_min))
+            merged[key] = [weight + other_weight, error + other_error]
+        self.load_counters(heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0]))
+
+    def load_counters(self, items):
+        self.counters = {key: list(counter) for key, counter in items}
+        self.heap = [(counter[0], key) for key, counter in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def top(self):
+        """
+        :return: список (url, оценка веса, погрешность) по убыванию оценки
+        """
+        return sorted(((key, weight, error) for key, (weight, error) in self.counters.items()),
+                      key=lambda item: item[1], reverse=True)
+
+    def dump(self):
+        return self.capacity, [(key, tuple(counter)) for key, counter in self.counters.items()]
+
+    @classmethod
+    def load(cls, state):
+        capacity, items = state
+        hitters = cls(capacity)
+        hitters.load_counters(items)
+        return hitters
+
+
+class BlockStats:
+    """
+    Суммы по блокам выборки для доверительных интервалов при выборке блоками (iter_sampled_blocks):
+    строки одного блока идут подряд и не независимы, поэтому единица выборки - блок. Для каждого
+    url хранятся суммы по блокам его числа запросов y и времени z (в микросекундах), их квадратов
+    и произведений на число запросов n и время t всего блока; из них дисперсия доли url
+    считается как дисперсия отношения сумм по блокам. Суммы целые, поэтому считаются без потери точности.
+    """
+    __slots__ = ('blocks', 'n_sum', 't_sum', 'n_sq', 't_sq', 'urls', 'pruned')
+
+    def __init__(self):
+        self.blocks = 0
+        self.n_sum = self.t_sum = 0  # запросов и времени во всех блоках
+        self.n_sq = self.t_sq = 0  # суммы квадратов n и t блоков
+        self.urls = {}  # url -> [сумма y, сумма y^2, сумма y*n, сумма z, сумма z^2, сумма z*t]
+        self.pruned = [0, 0]  # запросы и время текущего блока, url которых свёрнуты (prune)
+
+    def add_block(self, block_sums):
+        """
+        :param block_sums: url -> [y, z] одного блока
+        """
+        n = self.pruned[0] + sum(y for y, _ in block_sums.values())
+        t = self.pruned[1] + sum(z for _, z in block_sums.values())
+        self.pruned = [0, 0]
+        self.blocks += 1
+        self.n_sum += n
+        self.t_sum += t
+        self.n_sq += n * n
+        self.t_sq += t * t
+        for url, (y, z) in block_sums.items():
+            sums = self.urls.get(url)
+            if sums is None:
+                sums = self.urls[url] = [0] * 6
+            sums[0] += y
+            sums[1] += y * y
+            sums[2] += y * n
+            sums[3] += z
+            sums[4] += z * z
+            sums[5] += z * t
+
+    def merge(self, other):
+        self.blocks += other.blocks
+        self.n_sum += other.n_sum
+        self.t_sum += other.t_sum
+        self.n_sq += other.n_sq
+        self.t_sq += other.t_sq
+        for url, other_sums in other.urls.items():
+            sums = self.urls.get(url)
+            if sums is None:
+                self.urls[url] = list(other_sums)
+            else:
+                for number, value in enumerate(other_sums):
+                    sums[number] += value
+
+    def prune(self, table, block_sums):
+        """
+        fold посреди блока: запросы свёрнутых url текущего блока остаются в итогах блока
+        :param table: таблица после cap_tables
+        :param block_sums: суммы текущего блока, см. add_block
+        """
+        for url in [url for url in block_sums if url not in table]:
+            y, z = block_sums.pop(url)
+            self.pruned[0] += y
+            self.pruned[1] += z
+        self.fold(table)
+
+    def fold(self, table):
+        """
+        Согласует суммы с таблицей после cap_tables: суммы url, свёрнутых в OTHER_URL, удаляются.
+        Квадраты сумм по блокам не складываются, поэтому сумм для OTHER_URL тоже больше нет.
+        """
+        folded = [url for url in self.urls if url not in table]
+        if folded:
+            for url in folded:
+                del self.urls[url]
+            self.urls.pop(OTHER_URL, None)
+
+    def ratio_errors(self, url, fpc):
+        """
+        Стандартные ошибки долей url в числе запросов и во времени (линеаризация отношения сумм по блокам)
+        :param url:
+        :param fpc: поправка на конечную совокупность
+        :return: (count_se, time_se) или None, если сумм для url нет или блоков меньше двух
+        """
+        sums = self.urls.get(url)
+        if sums is None or self.blocks < 2 or not self.n_sum:
+            return None
+        y, y_sq, y_n, z, z_sq, z_t = sums
+        factor = fpc * self.blocks / (self.blocks - 1)
+        # сумма (y - R * n)^2 по блокам при R = y / n_sum, умноженная на n_sum^2, - целое число
+        count_var = factor * max(self.n_sum ** 2 * y_sq - 2 * self.n_sum * y * y_n + y ** 2 * self.n_sq, 0) \
+            / self.n_sum ** 4
+        time_var = 0
+        if self.t_sum:
+            time_var = factor * max(self.t_sum ** 2 * z_sq - 2 * self.t_sum * z * z_t + z ** 2 * self.t_sq, 0) \
+                / self.t_sum ** 4
+        return math.sqrt(count_var), math.sqrt(time_var)
+
+    def dump(self):
+        return self.blocks, self.n_sum, self.t_sum, self.n_sq, self.t_sq, list(self.urls.items())
+
+    @classmethod
+    def load(cls, state):
+        stats = cls()
+        stats.blocks, stats.n_sum, stats.t_sum, stats.n_sq, stats.t_sq, items = state
+        stats.urls = dict(items)
+        return stats
 
 
 def openfile(filename, mode='r'):
@@ -120,72 +920,1373 @@ def openfile(filename, mode='r'):
         return open(filename, mode)
 
 
-def parse_report(path_to_log_file, error_threshold_perc=51):
-    table = defaultdict(list)
+def iter_gzip_blocks(f_out, members=None):
+    """
+    Распаковывает gzip-поток из бинарного файла блоками, поддерживая несколько членов (members)
+    подряд, как в BGZF или при конкатенации .gz файлов.
+    :param f_out: файл, открытый в режиме 'rb' и установленный на начало члена
+    :param members: если передан список, в него добавляются пары [смещение в сжатом файле,
+    смещение в распакованных данных] для каждого члена, считая от текущей позиции файла
+    :return:
+    """
+    comp_offset = f_out.tell()
+    decomp_offset = 0
+    decompressor = None
+    data = b''
+    while True:
+        if not data:
+            data = f_out.read(READ_BLOCK_SIZE)
+            if not data:
+                break
+        if decompressor is None:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            if members is not None:
+                members.append([comp_offset, decomp_offset])
+        block = decompressor.decompress(data)
+        decomp_offset += len(block)
+        if decompressor.eof:
+            comp_offset += len(data) - len(decompressor.unused_data)
+            data = decompressor.unused_data
+            decompressor = None
+        else:
+            comp_offset += len(data)
+            data = b''
+        if block:
+            yield block
+
+
+def iter_lines_from_blocks(blocks, offset=0):
+    """
+    Разбивает поток блоков на строки без завершающего перевода строки
+    :param blocks:
+    :param offset: смещение первого блока в распакованных данных
+    :return: пары (смещение начала строки, строка)
+    """
+    tail = b''
+    for block in blocks:
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield offset, line
+            offset += len(line) + 1
+    if tail:
+        yield offset, tail
+
+
+def read_bgzf_index(f_out):
+    """
+    Строит индекс членов для BGZF-файла, читая только заголовки блоков: размер сжатого блока
+    хранится в поле BC заголовка, размер распакованного - в поле ISIZE в конце блока.
+    :param f_out: файл, открытый в режиме 'rb'
+    :return: список пар [смещение в сжатом файле, смещение в распакованных данных] или None,
+    если файл не в формате BGZF
+    """
+    members = []
+    comp_offset = decomp_offset = 0
+    while True:
+        f_out.seek(comp_offset)
+        header = f_out.read(12)
+        if not header:
+            return members
+        if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+            return None
+        extra = f_out.read(struct.unpack('<H', header[10:12])[0])
+        block_size = None
+        while len(extra) >= 4:
+            subfield_id, subfield_len = extra[:2], struct.unpack('<H', extra[2:4])[0]
+            if subfield_id == b'BC' and subfield_len == 2:
+                block_size = struct.unpack('<H', extra[4:6])[0] + 1
+            extra = extra[4 + subfield_len:]
+        if block_size is None:
+            return None
+        f_out.seek(comp_offset + block_size - 4)
+        members.append([comp_offset, decomp_offset])
+        decomp_offset += struct.unpack('<I', f_out.read(4))[0]
+        comp_offset += block_size
+
+
+def load_gzip_index(path_to_log_file):
+    """
+    Возвращает индекс членов gzip-файла из кэша рядом с файлом (<имя>.idx), если он соответствует
+    размеру и времени изменения файла, иначе пробует построить индекс BGZF по заголовкам.
+    :param path_to_log_file:
+    :return: список пар [смещение в сжатом файле, смещение в распакованных данных] или None
+    """
+    stat = os.stat(path_to_log_file)
+    try:
+        with open(f'{path_to_log_file}.idx', 'r') as f_out:
+            index = json.load(f_out)
+        if index['version'] == GZIP_INDEX_VERSION and index['size'] == stat.st_size \
+                and index['mtime'] == stat.st_mtime_ns:
+            return index['members']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(path_to_log_file, 'rb') as f_out:
+        members = read_bgzf_index(f_out)
+    if members:
+        save_gzip_index(path_to_log_file, members)
+    return members
+
+
+def save_gzip_index(path_to_log_file, members):
+    stat = os.stat(path_to_log_file)
+    index = {'version': GZIP_INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'members': members}
+    try:
+        write_atomic(f'{path_to_log_file}.idx', lambda f_in: json.dump(index, f_in))
+    except OSError as e:
+        logging.warning(f"Unable to save gzip index for {path_to_log_file}: {e.strerror}")
+
+
+def parse_request_line(buffer, start, end):
+    """
+    Достаёт url и $request_time из строки лога, которая лежит в buffer[start:end], без регулярных
+    выражений и без копирования всей строки: $request_time - последнее поле строки, url - второе
+    слово первого поля в кавычках ("$request"), которое должно заканчиваться протоколом HTTP/x.y.
+    Подходит любой метод и любая версия протокола, в том числе HTTP/2.0.
+    :param buffer: bytes или mmap
+    :param start:
+    :param end:
+    :return: (url в bytes, $request_time) или None, если строку разобрать не удалось
+    """
+    while end > start and buffer[end - 1] in b' \t\r\n':  # пробелы после $request_time, как strip()
+        end -= 1
+    time_start = buffer.rfind(b' ', start, end) + 1
+    request_start = buffer.find(b'"', start, time_start) + 1
+    if request_start <= start:
+        return None
+    request_end = buffer.find(b'"', request_start, time_start)
+    if request_end < 0:
+        return None
+    path_start = buffer.find(b' ', request_start, request_end) + 1
+    if path_start <= request_start:
+        return None
+    path_end = buffer.rfind(b' ', path_start, request_end)
+    if path_end <= path_start or buffer.find(b'HTTP/', path_end + 1, path_end + 6) != path_end + 1:
+        return None
+    try:
+        request_time = float(buffer[time_start:end])
+    except ValueError:
+        return None
+    if not math.isfinite(request_time):  # float() принимает nan и inf
+        return None
+    return buffer[path_start:path_end], request_time
+
+
+def parse_time_bucket(stamp, bucket_minutes):
+    """
+    Переводит начало $time_local (b'29/Jun/2017:03:50', до минут) в начало интервала: поля берутся
+    по фиксированным смещениям, без strptime. Часовой пояс не учитывается, интервалы - по местному
+    времени лога.
+    :param stamp:
+    :param bucket_minutes: длина интервала в минутах
+    :return: начало интервала в минутах от 0001-01-01 или None, если время разобрать не удалось
+    """
+    try:
+        minutes = (datetime.date(int(stamp[7:11]), MONTHS[stamp[3:6]], int(stamp[0:2])).toordinal() * 1440
+                   + int(stamp[12:14]) * 60 + int(stamp[15:17]))
+    except (KeyError, ValueError):
+        return None
+    return minutes - minutes % bucket_minutes
+
+
+@lru_cache(maxsize=4096)
+def format_time_bucket(minutes):
+    """
+    :param minutes: результат parse_time_bucket
+    :return: начало интервала в виде 'YYYY-MM-DDTHH:MM'
+    """
+    bucket_start = datetime.datetime.fromordinal(minutes // 1440) + datetime.timedelta(minutes=minutes % 1440)
+    return f"{bucket_start:%Y-%m-%dT%H:%M}"
+
+
+class UrlNormalizer:
+    """
+    Приводит url к шаблону до агрегации, чтобы url с идентификаторами не превращались
+    в миллионы отдельных строк отчёта: отрезает query string, заменяет числовые, hex и UUID
+    сегменты пути на {id}, {hex}, {uuid}, применяет пользовательские правила перезаписи
+    (регулярное выражение и замена, как в re.sub). Результат кэшируется по исходному url
+    в LRU-кэше ограниченного размера.
+    """
+    id_pattern = re.compile(rb'(?<=/)(?:(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                            rb'[0-9a-fA-F]{12})|(?P<id>\d+)|(?P<hex>(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,}))(?=/|$)')
+
+    def __init__(self, strip_query=False, replace_ids=False, rewrite_rules=(), cache_size=100000):
+        """
+        :param strip_query: отрезать query string
+        :param replace_ids: заменять идентификаторы в сегментах пути
+        :param rewrite_rules: список пар [регулярное выражение, замена], применяются по порядку
+        :param cache_size: размер LRU-кэша нормализованных url
+        """
+        self.settings = (bool(strip_query), bool(replace_ids), tuple(map(tuple, rewrite_rules)), cache_size)
+        self.strip_query = strip_query
+        self.replace_ids = replace_ids
+        self.rewrite_rules = [(re.compile(pattern.encode()), replacement.encode())
+                              for pattern, replacement in rewrite_rules]
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def __reduce__(self):
+        strip_query, replace_ids, rewrite_rules, cache_size = self.settings
+        return UrlNormalizer, (strip_query, replace_ids, rewrite_rules, cache_size)
+
+    @staticmethod
+    def _replace_id(match):
+        return b'{%s}' % match.lastgroup.encode()
+
+    def _normalize(self, path):
+        path, separator, query = path.partition(b'?')
+        if self.replace_ids:
+            path = self.id_pattern.sub(self._replace_id, path)
+        if separator and not self.strip_query:
+            path = path + separator + query
+        for pattern, replacement in self.rewrite_rules:
+            path = pattern.sub(replacement, path)
+        return path
+
+
+class LineSampler:
+    """
+    Состояние построчной выборки parse_spans: генератор случайных чисел и число строк до следующей
+    строки выборки (геометрическое распределение). Когда поток строк разбирается частями (--follow),
+    один LineSampler передаётся во все вызовы, и выборка продолжается, а не начинается заново.
+    """
+
+    def __init__(self, sample_rate, seed=0):
+        self.rnd = random.Random(seed)
+        self.log_skip = math.log(1 - sample_rate)
+        self.skip = self.next_skip()
+
+    def next_skip(self):
+        return int(math.log(1.0 - self.rnd.random()) / self.log_skip)
+
+
+def parse_lines(lines, **parse_options):
+    """
+    Разбирает строки лога (bytes) в частичный агрегат, см. parse_spans
+    :param lines: итерируемый объект со строками лога
+    :param parse_options: параметры parse_spans
+    :return:
+    """
+    return parse_spans(((line, 0, len(line)) for line in lines), **parse_options)
+
+
+def parse_spans(spans, exact=False, normalizer=None, max_urls=None, bucket_minutes=None, sample_rate=None,
+                heavy_hitters=0, sample_seed=0, sampler=None, block_stats=None):
+    """
+    Разбирает строки лога в частичный агрегат, который можно слить с другими через
+    merge_aggregates. Ключи таблицы - url в bytes, декодируются только при выводе.
+    Остальные функции разбора передают сюда свои **parse_options.
+    :param spans: итерируемый объект с тройками (буфер, начало строки, конец строки); буфер -
+    отдельная строка bytes или mmap всего файла
+    :param exact: хранить все значения $request_time для точных квантилей
+    :param normalizer: UrlNormalizer, который применяется к url до агрегации
+    :param max_urls: бюджет памяти: когда различных url становится MAX_URLS_HIGH_WATER * max_urls,
+    url с наименьшим суммарным временем сворачиваются в OTHER_URL (cap_tables). Точное ограничение
+    применяет cap_aggregate после слияния частей; None - без ограничения
+    :param bucket_minutes: дополнительно агрегировать по url и интервалам $time_local такой длины
+    в минутах (ключи таблицы buckets - пары (url, parse_time_bucket))
+    :param sample_rate: агрегировать только случайную долю строк (между выбранными строками
+    пропускается геометрически распределённое число строк); None - все строки
+    :param heavy_hitters: при sample_rate разбирать и пропущенные строки, отслеживая столько url
+    с наибольшим суммарным $request_time по всему потоку (SpaceSaving); 0 - не отслеживать
+    :param sample_seed: зерно выборки строк, выборка повторяется при том же зерне
+    :param sampler: LineSampler, продолжающий выборку предыдущего вызова; None - новый с sample_seed
+    :param block_stats: BlockStats выборки блоками; тогда spans - блоки (iter_sampled_blocks), а не строки
+    :return:
+    """
+    table = UrlTable(exact)
+    ids = table.ids
+    buckets = UrlTable(exact) if bucket_minutes else None
+    url_budget = MAX_URLS_HIGH_WATER * max_urls if max_urls is not None else None
+    block_sums = None  # url -> [запросы, время] текущего блока выборки блоками
+    if block_stats is not None:
+        block_sums = {}
+        spans = iter_block_spans(spans, block_stats, block_sums)
+    last_stamp = last_bucket = None  # подряд идущие строки обычно из одной минуты
+    bucket_ids = {}  # идентификатор url -> идентификатор в buckets для интервала last_bucket
+    own_num_rows = 0  # общее количество строк в логе
+    error_rows = 0  # количество нераспарсенных строк
+    own_num_request = 0  # общее количество распарсенных запросов
+    own_sum_request_time = 0  # $request_time всех запросов в микросекундах
+
+    hitters = SpaceSaving(heavy_hitters) if sample_rate is not None and heavy_hitters else None
+    if sampler is None and sample_rate is not None and sample_rate < 1:
+        sampler = LineSampler(sample_rate, sample_seed)
+    rnd = None
+    skip = 0  # строк до следующей строки выборки
+    if sampler is not None:
+        rnd, next_skip, skip = sampler.rnd, sampler.next_skip, sampler.skip
+    for buffer, start, end in spans:
+        if skip:
+            skip -= 1
+            if hitters is not None:
+                own_num_rows += 1
+                parsed = parse_request_line(buffer, start, end)
+                if parsed is None:
+                    error_rows += 1
+                    continue
+                path = parsed[0] if normalizer is None else normalizer.normalize(parsed[0])
+                hitters.add(path, round(parsed[1] * 1000000))
+            continue
+        if rnd is not None:
+            skip = next_skip()
+
+        own_num_rows += 1
+        parsed = parse_request_line(buffer, start, end)
+        if parsed is None:
+            error_rows += 1
+            continue
+
+        path, request_time = parsed
+        request_time_us = round(request_time * 1000000)
+        own_num_request += 1
+        own_sum_request_time += request_time_us
 
-    with openfile(path_to_log_file) as f_out:
-        own_num_rows = 0  # общее количество строк в логе
-        error_rows = 0  # количество нераспарсенных строк
-        own_num_request = 0  # общее количество распарсенных запросов
-        own_sum_request_time = 0  # $request_time всех запросов
-        for line in f_out:
-            own_num_rows += 1
-            match = re.search(r"(?P<path>\S+) HTTP\/1\.\d\".*\"(?P<request_time>.*)", line)
-            if match:
-                own_num_request += 1
-                path = match.group(1)
-                request_time = match.group(2)
-                request_time = float(request_time.strip())
-                own_sum_request_time += request_time
+        if normalizer is not None:
+            path = normalizer.normalize(path)
+        if hitters is not None:
+            hitters.add(path, request_time_us)
+        url_id = ids.get(path)
+        if url_id is None:
+            if url_budget is not None and len(table) >= url_budget:
+                # длинный хвост сворачивается, пока таблица не выросла сверх бюджета; меняются идентификаторы
+                table, buckets = cap_tables(table, buckets, max_urls)
+                ids = table.ids
+                bucket_ids = {}
+                if block_stats is not None:
+                    block_stats.prune(table, block_sums)
+                url_id = ids.get(path)
+            if url_id is None:
+                url_id = table.intern(path)
+        table.add(url_id, request_time, request_time_us)
+        if block_sums is not None:
+            sums = block_sums.get(path)
+            if sums is None:
+                block_sums[path] = [1, request_time_us]
+            else:
+                sums[0] += 1
+                sums[1] += request_time_us
+
+        if buckets is not None:
+            stamp_start = buffer.find(b'[', start, end) + 1
+            # без '[' в строке find вернёт -1, а срез с 0 взял бы начало всего буфера (mmap - начало файла)
+            stamp = buffer[stamp_start:stamp_start + 17] if stamp_start > start else b''
+            if stamp != last_stamp:
+                bucket = parse_time_bucket(stamp, bucket_minutes)
+                if bucket != last_bucket:
+                    bucket_ids = {}
+                last_stamp, last_bucket = stamp, bucket
+            if last_bucket is not None:
+                bucket_id = bucket_ids.get(url_id)
+                if bucket_id is None:
+                    bucket_id = bucket_ids[url_id] = buckets.intern((table.urls[url_id], last_bucket))
+                buckets.add(bucket_id, request_time, request_time_us)
 
-                table[path].append(request_time)
+    if sampler is not None:
+        sampler.skip = skip
+    return {'table': table, 'buckets': buckets, 'heavy_hitters': hitters, 'block_stats': block_stats,
+            'own_num_rows': own_num_rows, 'error_rows': error_rows, 'own_num_request': own_num_request,
+            'own_sum_request_time': own_sum_request_time}
 
+
+def merge_aggregates(aggregates, max_urls=None):
+    """
+    Сливает частичные агрегаты parse_lines (или результаты parse_report) в один, порядок
+    агрегатов сохраняется.
+    :param aggregates: непустой список агрегатов
+    :param max_urls: после слияния оставить не больше стольких url (cap_aggregate)
+    :return:
+    """
+    merged = aggregates[0]
+    for aggregate in aggregates[1:]:
+        merged['table'].merge(aggregate['table'])
+        if merged.get('buckets') is not None:
+            merged['buckets'].merge(aggregate['buckets'])
+        if merged.get('heavy_hitters') is not None:
+            merged['heavy_hitters'].merge(aggregate['heavy_hitters'])
+        if merged.get('block_stats') is not None:
+            # без сумм по блокам у одного из агрегатов интервалы по блокам не посчитать
+            if aggregate.get('block_stats') is None:
+                merged['block_stats'] = None
             else:
-                error_rows += 1
-    error_parse_perc = error_rows * 100 / own_num_rows if own_num_rows > 0 else 0
+                merged['block_stats'].merge(aggregate['block_stats'])
+        for key, value in aggregate.items():
+            if key not in ('table', 'buckets', 'heavy_hitters', 'block_stats', 'sample_rate'):
+                merged[key] += value
+    return cap_aggregate(merged, max_urls)
+
+
+def cap_aggregate(aggregate, max_urls=None):
+    """
+    Ограничивает число url агрегата: url с наименьшим суммарным временем сворачиваются в OTHER_URL
+    вместе со своими интервалами. Применяется к полностью слитому агрегату, поэтому, пока при разборе
+    не был превышен бюджет url (parse_spans), параллельный разбор даёт тот же результат, что и последовательный.
+    :param aggregate: агрегат parse_lines или результат parse_report
+    :param max_urls: None - без ограничения
+    :return: тот же агрегат
+    """
+    if max_urls is None:
+        return aggregate
+    aggregate['table'], aggregate['buckets'] = cap_tables(aggregate['table'], aggregate.get('buckets'), max_urls)
+    if aggregate.get('block_stats') is not None:
+        aggregate['block_stats'].fold(aggregate['table'])
+    return aggregate
+
+
+def cap_tables(table, buckets, max_urls):
+    """
+    UrlTable.cap для таблицы url и таблицы её интервалов: интервалы свёрнутых url
+    сворачиваются в интервалы OTHER_URL
+    :param table: UrlTable по url
+    :param buckets: UrlTable по (url, интервал) или None
+    :param max_urls:
+    :return: (table, buckets), те же объекты, если ограничение не сработало
+    """
+    capped = table.cap(max_urls)
+    if capped is table or buckets is None:
+        return capped, buckets
+    return capped, buckets.fold(lambda key: key if key[0] in capped else (OTHER_URL, key[1]))
+
+
+def iter_buffer_spans(buffer, start=0, end=None):
+    """
+    Возвращает границы строк буфера, которые начинаются в диапазоне байт [start, end).
+    Строка, начатая до start, принадлежит предыдущему диапазону, поэтому соседние
+    диапазоны не теряют и не дублируют строки. Сами строки не копируются.
+    :param buffer: bytes или mmap
+    :param start:
+    :param end: None - до конца буфера
+    :return: тройки (буфер, начало строки, конец строки без перевода строки)
+    """
+    size = len(buffer)
+    if start > 0 and buffer[start - 1] != 10:  # b'\n'
+        start = buffer.find(b'\n', start) + 1 or size
+    end = size if end is None else min(end, size)
+    find = buffer.find
+    position = start
+    while position < end:
+        line_end = find(b'\n', position)
+        if line_end < 0:
+            line_end = size
+        yield buffer, position, line_end
+        position = line_end + 1
+
+
+def iter_sampled_blocks(buffer, sample_rate, start=0, end=None):
+    """
+    Возвращает для каждого выбранного блока по SAMPLE_BLOCK_SIZE байт границы его строк, которые
+    начинаются в диапазоне [start, end). Блок выбирается с вероятностью sample_rate по своему номеру,
+    поэтому выборка не зависит от деления файла на диапазоны, а невыбранные блоки не читаются.
+    """
+    end = len(buffer) if end is None else min(end, len(buffer))
+    for block_start in range(start - start % SAMPLE_BLOCK_SIZE, end, SAMPLE_BLOCK_SIZE):
+        if random.Random(block_start // SAMPLE_BLOCK_SIZE).random() < sample_rate:
+            yield iter_buffer_spans(buffer, max(block_start, start), min(block_start + SAMPLE_BLOCK_SIZE, end))
+
+
+def iter_sampled_spans(buffer, sample_rate, start=0, end=None):
+    """
+    Границы строк всех выбранных блоков iter_sampled_blocks подряд
+    """
+    for spans in iter_sampled_blocks(buffer, sample_rate, start, end):
+        yield from spans
+
+
+def is_block_sampled(parse_options):
+    """
+    Несжатый лог в приближённом режиме без heavy hitters выбирается блоками, а не строками
+    """
+    sample_rate = parse_options.get('sample_rate')
+    return sample_rate is not None and sample_rate < 1 and not parse_options.get('heavy_hitters')
+
+
+def iter_block_spans(blocks, block_stats, block_sums):
+    """
+    Границы строк блоков подряд; после каждого блока его суммы block_sums, которые заполняет
+    parse_spans, переносятся в block_stats
+    :param blocks: результат iter_sampled_blocks
+    :param block_stats: BlockStats
+    :param block_sums: url -> [y, z] текущего блока
+    """
+    for spans in blocks:
+        yield from spans
+        block_stats.add_block(block_sums)
+        block_sums.clear()
+
+
+def parse_chunk(path_to_log_file, start=0, end=None, parse_options=None):
+    """
+    Разбирает строки несжатого файла, которые начинаются в диапазоне байт [start, end).
+    Файл отображается в память через mmap и сканируется как один буфер: строки не декодируются
+    и не копируются, из файла материализуются только url и $request_time. В приближённом режиме
+    без отслеживания heavy hitters выборка делается блоками (iter_sampled_blocks), а не строками,
+    и для доверительных интервалов собираются суммы по блокам (BlockStats).
+    """
+    parse_options = parse_options or {}
+    block_stats = BlockStats() if is_block_sampled(parse_options) else None
+    with open(path_to_log_file, 'rb') as f_out:
+        if os.fstat(f_out.fileno()).st_size == 0:
+            return parse_spans((), block_stats=block_stats, **parse_options)
+        with mmap.mmap(f_out.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if block_stats is not None:
+                if hasattr(buffer, 'madvise'):
+                    buffer.madvise(mmap.MADV_RANDOM)
+                return parse_spans(iter_sampled_blocks(buffer, parse_options['sample_rate'], start, end),
+                                   block_stats=block_stats, **{**parse_options, 'sample_rate': None})
+            if hasattr(buffer, 'madvise'):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            return parse_spans(iter_buffer_spans(buffer, start, end), sample_seed=start, **parse_options)
+
+
+def parse_gzip_chunk(path_to_log_file, comp_offset, offset, start, end, parse_options=None):
+    """
+    Разбирает строки gzip-файла, которые начинаются в диапазоне распакованных байт [start, end).
+    Распаковка начинается с члена, который находится по смещению comp_offset в сжатом файле
+    и offset в распакованных данных; он должен начинаться не позже start - 1.
+    """
+    def iter_lines():
+        with open(path_to_log_file, 'rb') as f_out:
+            f_out.seek(comp_offset)
+            for position, line in iter_lines_from_blocks(iter_gzip_blocks(f_out), offset):
+                if end is not None and position >= end:
+                    break
+                if position >= start:
+                    yield line
+
+    return parse_lines(iter_lines(), sample_seed=start, **(parse_options or {}))
+
+
+def split_gzip_members(members, chunks):
+    """
+    Делит члены gzip-файла на chunks групп примерно одинакового сжатого размера
+    :param members: индекс из load_gzip_index
+    :param chunks:
+    :return: список (смещение в сжатом файле, смещение в распакованных данных, start, end)
+    для parse_gzip_chunk; распаковка каждой группы начинается с предыдущего непустого члена,
+    чтобы определить, где начинается первая строка группы
+    """
+    comp_offsets = [comp_offset for comp_offset, _ in members]
+    bounds = sorted({bisect_left(comp_offsets, comp_offsets[-1] * number // chunks) for number in range(1, chunks)})
+    bounds = [first for first in bounds if 0 < first < len(members)]
+
+    result = []
+    for first, last in zip([0] + bounds, bounds + [None]):
+        previous = max(first - 1, 0)
+        while previous > 0 and members[previous][1] >= members[first][1]:
+            previous -= 1
+        result.append((*members[previous], members[first][1], members[last][1] if last is not None else None))
+    return result
+
+
+def split_file(path_to_log_file, chunks, align=1):
+    """
+    Делит файл на chunks диапазонов байт примерно одинакового размера
+    :param path_to_log_file:
+    :param chunks:
+    :param align: границы диапазонов кратны align (блоки выборки не делятся между диапазонами)
+    :return: список пар (start, end)
+    """
+    size = os.path.getsize(path_to_log_file)
+    bounds = [size * number // chunks // align * align for number in range(chunks)] + [size]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end] or [(0, size)]
+
+
+def parse_report(path_to_log_file, error_threshold_perc=51, workers=1, **parse_options):
+    """
+    Разбирает лог потоково: по каждому url хранится только строка UrlTable, поэтому память
+    ограничена числом различных url, а не числом запросов. При workers > 1 несжатый файл
+    делится на диапазоны байт, которые разбираются в отдельных процессах и затем сливаются;
+    результат совпадает с последовательным разбором. Gzip-файл разбирается параллельно по группам
+    членов, если он в формате BGZF или для него уже есть индекс, иначе - последовательно.
+    :param path_to_log_file:
+    :param error_threshold_perc: допустимый процент нераспарсенных строк
+    :param workers: количество процессов для разбора
+    :param parse_options: параметры parse_lines (exact, normalizer, max_urls, bucket_minutes)
+    :return:
+    """
+    with stage_metrics.stage('parse') as stage:
+        aggregate = cap_aggregate(_parse_report(path_to_log_file, workers, parse_options),
+                                  parse_options.get('max_urls'))
+        stage['bytes'] = os.path.getsize(path_to_log_file)
+        stage['lines'] = aggregate['own_num_rows']
+        stage['distinct_urls'] = len(aggregate['table'])
+
+    own_num_rows = aggregate['own_num_rows']
+    error_parse_perc = aggregate['error_rows'] * 100 / own_num_rows if own_num_rows > 0 else 0
     logging.info(f'Percentage of errors when parsing a log: {error_parse_perc}%')
     if error_parse_perc >= error_threshold_perc:
-        message = "Critical error percentage when parsing a log: {error_parse_perc}%"
+        message = f"Critical error percentage when parsing a log: {error_parse_perc}%"
         logging.error(message)
         sys.exit(message)
 
-    return {'table': table, 'own_num_request': own_num_request, 'own_sum_request_time': own_sum_request_time}
+    return {'table': aggregate['table'], 'buckets': aggregate['buckets'],
+            'heavy_hitters': aggregate['heavy_hitters'], 'block_stats': aggregate['block_stats'],
+            'sample_rate': parse_options.get('sample_rate'),
+            'own_num_request': aggregate['own_num_request'],
+            'own_sum_request_time': aggregate['own_sum_request_time'] / 1000000}
+
+
+def _parse_report(path_to_log_file, workers, parse_options):
+    is_gzip = path_to_log_file.endswith('.gz')
+    members = load_gzip_index(path_to_log_file) if is_gzip and workers > 1 else None
+
+    if workers > 1 and not is_gzip:
+        align = SAMPLE_BLOCK_SIZE if is_block_sampled(parse_options) else 1
+        starts, ends = zip(*split_file(path_to_log_file, workers * 4, align))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            aggregates = list(executor.map(parse_chunk, repeat(path_to_log_file), starts, ends,
+                                           repeat(parse_options)))
+        aggregate = merge_aggregates(aggregates, parse_options.get('max_urls'))
+    elif members is not None and len(members) > 1:
+        chunks = split_gzip_members(members, workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            aggregates = list(executor.map(parse_gzip_chunk, repeat(path_to_log_file), *zip(*chunks),
+                                           repeat(parse_options)))
+        aggregate = merge_aggregates(aggregates, parse_options.get('max_urls'))
+    elif is_gzip:
+        # последовательная распаковка; заодно строим индекс членов для следующих запусков
+        members = []
+        with open(path_to_log_file, 'rb') as f_out:
+            blocks = stage_metrics.iter_blocks('read', iter_gzip_blocks(f_out, members))
+            aggregate = parse_lines((line for _, line in iter_lines_from_blocks(blocks)), **parse_options)
+        if len(members) > 1:
+            save_gzip_index(path_to_log_file, members)
+    else:
+        aggregate = parse_chunk(path_to_log_file, parse_options=parse_options)
+    return aggregate
+
+
+def get_snapshot_key(path_to_log_file, **parse_options):
+    """
+    Снимок агрегата действителен, пока у файла лога не изменились имя, размер и время изменения,
+    а также параметры разбора
+    """
+    stat = os.stat(path_to_log_file)
+    options = sorted((name, getattr(value, 'settings', value)) for name, value in parse_options.items()
+                     if value is not None and value is not False)
+    return [os.path.basename(path_to_log_file), stat.st_size, stat.st_mtime_ns, options]
+
+
+def save_snapshot(path_to_snapshot, key, table_dict):
+    """
+    Сохраняет результат parse_report в бинарный снимок: заголовок SNAPSHOT_MAGIC с версией формата,
+    затем сжатый zlib pickle из примитивных типов (без классов модуля, чтобы снимок не зависел
+    от способа запуска анализатора). Файл записывается атомарно.
+    :param path_to_snapshot:
+    :param key: результат get_snapshot_key
+    :param table_dict: результат parse_report
+    :return:
+    """
+    payload = {'key': key,
+               'own_num_request': table_dict['own_num_request'],
+               'own_sum_request_time': table_dict['own_sum_request_time'],
+               'table': table_dict['table'].dump(),
+               'buckets': table_dict['buckets'] and table_dict['buckets'].dump(),
+               'heavy_hitters': table_dict['heavy_hitters'] and table_dict['heavy_hitters'].dump(),
+               'block_stats': table_dict['block_stats'] and table_dict['block_stats'].dump(),
+               'sample_rate': table_dict['sample_rate']}
+    os.makedirs(os.path.dirname(path_to_snapshot), exist_ok=True)
+
+    def write_snapshot(f_in):
+        f_in.write(SNAPSHOT_MAGIC + struct.pack('<H', SNAPSHOT_VERSION))
+        f_in.write(zlib.compress(pickle.dumps(payload, protocol=4)))
+
+    write_atomic(path_to_snapshot, write_snapshot, mode='wb')
+
+
+def load_snapshot(path_to_snapshot, key):
+    """
+    Загружает снимок, сохранённый save_snapshot
+    :param path_to_snapshot:
+    :param key: результат get_snapshot_key для текущего файла лога
+    :return: результат parse_report или None, если снимка нет, он другой версии или устарел
+    """
+    try:
+        with open(path_to_snapshot, 'rb') as f_out:
+            header = f_out.read(len(SNAPSHOT_MAGIC) + 2)
+            if header != SNAPSHOT_MAGIC + struct.pack('<H', SNAPSHOT_VERSION):
+                return None
+            payload = pickle.loads(zlib.decompress(f_out.read()))
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error, pickle.UnpicklingError) as e:
+        logging.warning(f"Broken snapshot {path_to_snapshot}: {e}")
+        return None
+
+    if payload['key'] != key:
+        return None
+    return {'table': UrlTable.load(payload['table']),
+            'buckets': payload['buckets'] and UrlTable.load(payload['buckets']),
+            'heavy_hitters': payload['heavy_hitters'] and SpaceSaving.load(payload['heavy_hitters']),
+            'block_stats': payload['block_stats'] and BlockStats.load(payload['block_stats']),
+            'sample_rate': payload['sample_rate'],
+            'own_num_request': payload['own_num_request'],
+            'own_sum_request_time': payload['own_sum_request_time']}
+
+
+def parse_report_cached(path_to_log_file, snapshot_dir=None, workers=1, **parse_options):
+    """
+    Возвращает результат parse_report из снимка в snapshot_dir, если он есть и актуален,
+    иначе разбирает лог и сохраняет снимок.
+    :param path_to_log_file:
+    :param snapshot_dir: None - не использовать снимки
+    :param workers:
+    :param parse_options: параметры parse_lines
+    :return:
+    """
+    if snapshot_dir is None:
+        return parse_report(path_to_log_file, workers=workers, **parse_options)
+
+    path_to_snapshot = os.path.join(snapshot_dir, f'{os.path.basename(path_to_log_file)}.snapshot')
+    key = get_snapshot_key(path_to_log_file, **parse_options)
+    table_dict = load_snapshot(path_to_snapshot, key)
+    if table_dict is not None:
+        logging.info(f"Using snapshot {path_to_snapshot}")
+        return table_dict
+
+    table_dict = parse_report(path_to_log_file, workers=workers, **parse_options)
+    try:
+        save_snapshot(path_to_snapshot, key, table_dict)
+    except OSError as e:
+        logging.warning(f"Unable to save snapshot {path_to_snapshot}: {e.strerror}")
+    return table_dict
 
 
 def calculate_metrics(table_collection: dict, size=1000):
+    """
+    Считает метрики отчёта для size url с наибольшим суммарным $request_time. Сначала url
+    отбираются кучей по сырым агрегатам, и только для них считаются строки отчёта.
+    :param table_collection: результат parse_report
+    :param size: REPORT_SIZE
+    :return:
+    """
+    with stage_metrics.stage('calculate_metrics') as stage:
+        stage['distinct_urls'] = len(table_collection['table'])
+        return _calculate_metrics(table_collection, size)
+
+
+def _calculate_metrics(table_collection, size):
+    if table_collection.get('sample_rate') is not None:
+        return calculate_sampled_metrics(table_collection, size)
 
     table_list = list()
     table = table_collection['table']
+    top_ids = heapq.nlargest(size, range(len(table)), key=table.time_sums_us.__getitem__)
 
     round_prec = 3
-    for path, value_list in table.items():
-        ct = len(value_list)
-        time_sum = round(sum(value_list), round_prec)
-        time_avg = round(sum(value_list) / ct, round_prec)
+    for url_id in top_ids:
+        ct = table.counts[url_id]
+        time_sum = round(table.time_sum(url_id), round_prec)
+        time_avg = round(table.time_sum(url_id) / ct, round_prec)
         count_perc = round(ct * 100 / table_collection['own_num_request'], round_prec)
         time_perc = round(time_sum * 100 / table_collection['own_sum_request_time'], round_prec)
-        time_max = round(max(value_list), round_prec)
-        table_list.append({'url': path,
+        time_max = round(table.time_maxes[url_id], round_prec)
+        table_list.append({'url': table.urls[url_id].decode('utf-8', errors='replace'),
                            'count': ct,
                            'time_sum': time_sum,
                            'time_avg': time_avg,
                            'count_perc': count_perc,
                            'time_perc': time_perc,
                            'time_max': time_max,
-                           'time_med': running_median_insort(value_list, window_size=ct)[-1]})
+                           'time_med': round(table.quantile(url_id, 0.5), round_prec)})
 
-    table_list.sort(key=lambda el: el['time_sum'], reverse=True)
-    table_list = table_list[0:size]
+    buckets = table_collection.get('buckets')
+    if buckets is not None:
+        add_time_series(table_list, [table.urls[url_id] for url_id in top_ids], buckets)
     return table_list
 
 
+def calculate_sampled_metrics(table_collection: dict, size=1000):
+    """
+    Метрики приближённого режима (--sample): количество и сумма времени url масштабируются на долю
+    выборки, у count_perc, time_perc и time_med добавляются 95% доверительные интервалы (*_ci).
+    Доли оцениваются как отношения по выборке с дисперсией линеаризованного отношения, интервал
+    медианы - по порядковым статистикам. При выборке строками единица выборки - строка, при выборке
+    блоками (block_stats) - блок: дисперсия долей считается по суммам блоков, а интервал медианы
+    расширяется на эффект дизайна доли запросов url. Для url без сумм по блокам (OTHER_URL после
+    MAX_URLS) интервалы не приводятся. Для url из сводки heavy hitters (весь поток) сводка даёт
+    гарантированные границы суммы времени time_sum_ci, оценка по выборке приводится в них; такие
+    url попадают в отчёт, даже если не попали в выборку (тогда time_sum - нижняя граница).
+    :param table_collection: результат parse_report с sample_rate
+    :param size: REPORT_SIZE
+    :return:
+    """
+    table = table_collection['table']
+    sample_rate = table_collection['sample_rate']
+    num_request = table_collection['own_num_request']
+    sum_request_time = table_collection['own_sum_request_time']
+    hitters = {}
+    if table_collection.get('heavy_hitters') is not None:
+        hitters = {url: ((weight - error) / 1000000, weight / 1000000)
+                   for url, weight, error in table_collection['heavy_hitters'].top()}
+
+    def estimate_time_sum(url_id):
+        time_sum = table.time_sum(url_id) / sample_rate
+        bounds = hitters.get(table.urls[url_id])
+        return time_sum if bounds is None else min(max(time_sum, bounds[0]), bounds[1])
+
+    candidates = [(estimate_time_sum(url_id), url_id, table.urls[url_id]) for url_id in
+                  heapq.nlargest(size, range(len(table)), key=estimate_time_sum)]
+    candidates += [(low, None, url) for url, (low, _) in hitters.items() if url not in table]
+    candidates = heapq.nlargest(size, candidates, key=lambda candidate: candidate[0])
+
+    z = CONFIDENCE_Z
+    fpc = 1 - sample_rate  # поправка на конечную совокупность
+    block_stats = table_collection.get('block_stats')
+    total_sq_sum = math.fsum(table.time_sq_sum(url_id) for url_id in range(len(table)))
+    round_prec = 3
+    table_list = list()
+    for time_sum, url_id, url in candidates:
+        row = {'url': url.decode('utf-8', errors='replace'), 'time_sum': round(time_sum, round_prec)}
+        if url_id is not None:
+            ct = table.counts[url_id]
+            count_perc = ct / num_request
+            count_srs_var = fpc * count_perc * (1 - count_perc) / num_request
+            time_perc = 0
+            if sum_request_time:
+                time_perc = table.time_sum(url_id) / sum_request_time
+            if block_stats is None:
+                count_se, deff = math.sqrt(count_srs_var), 1
+                time_se = 0
+                if sum_request_time:
+                    url_sq_sum = table.time_sq_sum(url_id)
+                    time_se = math.sqrt(fpc * ((1 - time_perc) ** 2 * url_sq_sum +
+                                               time_perc ** 2 * max(total_sq_sum - url_sq_sum, 0))) / sum_request_time
+                errors = count_se, time_se
+            else:
+                errors = block_stats.ratio_errors(url, fpc)
+                if errors is not None:
+                    # эффект дизайна: во сколько раз выборка блоков менее точна, чем выборка строк того же объёма
+                    deff = max(errors[0] ** 2 / count_srs_var, 1) if count_srs_var else 1
+            row.update({'count': round(ct / sample_rate),
+                        'time_avg': round(table.time_sum(url_id) / ct, round_prec),
+                        'count_perc': round(count_perc * 100, round_prec),
+                        'count_perc_ci': None,
+                        'time_perc': round(time_perc * 100, round_prec),
+                        'time_perc_ci': None,
+                        'time_max': round(table.time_maxes[url_id], round_prec),
+                        'time_med': round(table.quantile(url_id, 0.5), round_prec),
+                        'time_med_ci': None})
+            if errors is not None:
+                count_se, time_se = errors
+                median_delta = z * 0.5 * math.sqrt(fpc * deff / ct)
+                row.update({'count_perc_ci': [round(max(count_perc - z * count_se, 0) * 100, round_prec),
+                                              round(min(count_perc + z * count_se, 1) * 100, round_prec)],
+                            'time_perc_ci': [round(max(time_perc - z * time_se, 0) * 100, round_prec),
+                                             round(min(time_perc + z * time_se, 1) * 100, round_prec)],
+                            'time_med_ci': [round(table.quantile(url_id, max(0.5 - median_delta, 0)), round_prec),
+                                            round(table.quantile(url_id, min(0.5 + median_delta, 1)), round_prec)]})
+        else:
+            # heavy hitter, не попавший в выборку: известна только оценка суммы времени
+            row.update(dict.fromkeys(('count', 'time_avg', 'count_perc', 'count_perc_ci', 'time_perc', 'time_perc_ci',
+                                      'time_max', 'time_med', 'time_med_ci')))
+        row['time_sum_ci'] = None
+        if url in hitters:
+            row['time_sum_ci'] = [round(bound, round_prec) for bound in hitters[url]]
+        table_list.append(row)
+
+    buckets = table_collection.get('buckets')
+    if buckets is not None:
+        add_time_series(table_list, [url for _, _, url in candidates], buckets, sample_rate)
+    return table_list
+
+
+def add_time_series(table_list, urls, buckets, sample_rate=None):
+    """
+    Добавляет строкам отчёта колонку time_series: непустые интервалы url по возрастанию времени,
+    [начало интервала, count, time_med, time_max]. Таблица интервалов просматривается один раз.
+    :param table_list: строки отчёта
+    :param urls: url строк отчёта в bytes, в том же порядке
+    :param buckets: таблица интервалов parse_spans
+    :param sample_rate: доля выборки; count масштабируется на неё, как и count строки отчёта
+    :return:
+    """
+    series = {url: [] for url in urls}
+    for bucket_id, (url, bucket) in enumerate(buckets.urls):
+        url_series = series.get(url)
+        if url_series is not None:
+            url_series.append((bucket, bucket_id))
+
+    scale = 1 / sample_rate if sample_rate else 1
+    round_prec = 3
+    for row, url in zip(table_list, urls):
+        row['time_series'] = [[format_time_bucket(bucket),
+                               round(buckets.counts[bucket_id] * scale),
+                               round(buckets.quantile(bucket_id, 0.5), round_prec),
+                               round(buckets.time_maxes[bucket_id], round_prec)]
+                              for bucket, bucket_id in sorted(series[url])]
+
+
+def get_table_columns(table_collection: dict) -> dict:
+    """
+    Возвращает метрики всех url (а не только REPORT_SIZE) колонками, без округления.
+    В приближённом режиме count и time_sum - оценки для всего лога (выборка, делённая на долю),
+    как в calculate_sampled_metrics; средние и доли от масштабирования не зависят.
+    :param table_collection: результат parse_report
+    :return: {колонка: список значений}
+    """
+    table = table_collection['table']
+    num_request = table_collection['own_num_request'] or 1
+    sum_request_time = table_collection['own_sum_request_time'] or 1
+    sample_rate = table_collection.get('sample_rate')
+    scale = 1 / sample_rate if sample_rate else 1
+    time_sums = [time_sum_us / 1000000 for time_sum_us in table.time_sums_us]
+    return {'url': [url.decode('utf-8', errors='replace') for url in table.urls],
+            'count': list(table.counts) if scale == 1 else [ct * scale for ct in table.counts],
+            'time_sum': time_sums if scale == 1 else [time_sum * scale for time_sum in time_sums],
+            'time_avg': [time_sum / ct for time_sum, ct in zip(time_sums, table.counts)],
+            'count_perc': [ct * 100 / num_request for ct in table.counts],
+            'time_perc': [time_sum * 100 / sum_request_time for time_sum in time_sums],
+            'time_max': list(table.time_maxes),
+            'time_med': [table.quantile(url_id, 0.5) for url_id in range(len(table))]}
+
+
+def get_export_format(export_format):
+    """
+    Выбирает формат выгрузки агрегатов: parquet (нужен pyarrow) или npz (нужен numpy),
+    "auto" - parquet, если доступен pyarrow, иначе npz
+    :param export_format: "parquet", "npz", "auto" или None
+    :return: формат или None, если выгрузка выключена или недоступна
+    """
+    if export_format == "auto":
+        export_format = "parquet" if pyarrow is not None else "npz"
+    if export_format not in (None, "parquet", "npz"):
+        sys.exit(f"Unknown EXPORT_FORMAT: {export_format}")
+    if (export_format == "parquet" and pyarrow is None) or (export_format == "npz" and numpy is None):
+        logging.warning(f"Aggregates are not exported: {export_format} needs "
+                        f"{'pyarrow' if export_format == 'parquet' else 'numpy'}")
+        return None
+    return export_format
+
+
+def export_aggregates(table_collection: dict, days: list, path: str):
+    """
+    Записывает агрегаты всех url и итоги по дням в колоночный файл: .parquet через pyarrow
+    (итоги по дням - в метаданных схемы) или .npz через numpy (url_* - колонки url, day_* - итоги,
+    сами url - один массив uint8 с UTF-8 всех url urls_utf8 и границы url urls_offsets, чтобы файл
+    читался без pickle и без numpy)
+    :param table_collection: результат parse_report
+    :param days: итоги по дням [{'date': 'YYYY-MM-DD', 'count': ..., 'time_sum': ...}]
+    :param path: путь к файлу, формат определяется расширением
+    :return:
+    """
+    with stage_metrics.stage('export') as stage:
+        stage['distinct_urls'] = len(table_collection['table'])
+        columns = get_table_columns(table_collection)
+        if path.endswith('.parquet'):
+            arrow_table = pyarrow.table(columns).replace_schema_metadata({'days': json.dumps(days)})
+            write_atomic(path, lambda f_in: pyarrow.parquet.write_table(arrow_table, f_in), mode="wb")
+        else:
+            # в массиве str каждая строка занимала бы место самого длинного url, массив object требует pickle
+            urls = [url.encode('utf-8') for url in columns.pop('url')]
+            offsets = numpy.zeros(len(urls) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(url) for url in urls], out=offsets[1:])
+            arrays = {'urls_utf8': numpy.frombuffer(b''.join(urls), dtype=numpy.uint8), 'urls_offsets': offsets}
+            arrays.update({f'url_{name}': numpy.array(values) for name, values in columns.items()})
+            arrays.update({f'day_{name}': numpy.array([day[name] for day in days],
+                                                      dtype=str if name == 'date' else None)
+                           for name in ('date', 'count', 'time_sum')})
+            write_atomic(path, lambda f_in: numpy.savez(f_in, **arrays), mode="wb")
+
+
+def load_aggregates(path: str) -> dict:
+    """
+    Загружает результат export_aggregates без разбора логов
+    :param path: .parquet или .npz
+    :return: {'table': {колонка: массив}, 'days': {колонка: массив}}
+    """
+    if path.endswith('.parquet'):
+        arrow_table = pyarrow.parquet.read_table(path)
+        days = json.loads(arrow_table.schema.metadata[b'days'])
+        return {'table': {name: arrow_table.column(name) for name in arrow_table.column_names},
+                'days': {name: [day[name] for day in days] for name in ('date', 'count', 'time_sum')}}
+    with numpy.load(path) as arrays:
+        blob = arrays['urls_utf8'].tobytes()
+        offsets = arrays['urls_offsets'].tolist()
+        urls = numpy.array([blob[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])],
+                           dtype=object)
+        return {'table': {'url': urls, **{name[len('url_'):]: arrays[name] for name in arrays.files
+                                          if name.startswith('url_')}},
+                'days': {name[len('day_'):]: arrays[name] for name in arrays.files if name.startswith('day_')}}
+
+
+class LogFollower:
+    """
+    Читает из растущего файла лога только дописанные байты. Запоминает inode и смещение:
+    после ротации (файл переименован, на его месте новый) переходит на новый файл с начала,
+    но, как tail -F, продолжает дочитывать старый, пока nginx не переоткроет лог (logrotate
+    create и postrotate kill -USR1): старый файл закрывается, когда он не менялся целый опрос,
+    а в новом уже есть данные. После усечения (copytruncate) файл читается заново.
+    """
+
+    def __init__(self, path_to_log_file):
+        self.path_to_log_file = path_to_log_file
+        self.f_out = None
+        self.inode = None
+        self.tail = b''
+        self.rotated = None  # файл до ротации, который ещё может дописываться
+        self.rotated_tail = b''
+
+    def _open(self):
+        try:
+            self.f_out = open(self.path_to_log_file, 'rb')
+        except FileNotFoundError:
+            self.f_out = None
+            return False
+        self.inode = os.fstat(self.f_out.fileno()).st_ino
+        return True
+
+    @staticmethod
+    def _read_to_end(f_out, tail):
+        """
+        Читает файл до конца, возвращает полные строки
+        :param f_out:
+        :param tail: незаконченная строка предыдущего чтения
+        :return: (через yield from) новая незаконченная строка
+        """
+        while True:
+            block = f_out.read(READ_BLOCK_SIZE)
+            if not block:
+                return tail
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop()
+            yield from lines
+
+    def _close_rotated(self):
+        if self.rotated_tail:
+            yield self.rotated_tail
+        self.rotated.close()
+        self.rotated, self.rotated_tail = None, b''
+
+    def iter_new_lines(self):
+        """
+        Возвращает полные строки, дописанные с прошлого вызова; незаконченная последняя строка
+        откладывается до следующего вызова
+        :return:
+        """
+        if self.rotated is not None:
+            position = self.rotated.tell()
+            self.rotated_tail = yield from self._read_to_end(self.rotated, self.rotated_tail)
+            if self.rotated.tell() == position and self.f_out is not None \
+                    and os.fstat(self.f_out.fileno()).st_size:
+                yield from self._close_rotated()
+
+        if self.f_out is None and not self._open():
+            return
+        self.tail = yield from self._read_to_end(self.f_out, self.tail)
+
+        try:
+            stat = os.stat(self.path_to_log_file)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self.inode:
+            if self.rotated is not None:  # вторая ротация раньше, чем nginx переоткрыл первый файл
+                yield from self._close_rotated()
+            self.rotated, self.rotated_tail = self.f_out, self.tail
+            self.f_out, self.tail = None, b''
+            if self._open():
+                self.tail = yield from self._read_to_end(self.f_out, self.tail)
+        elif stat.st_size < self.f_out.tell():
+            logging.info(f"Log file was truncated, reading from the beginning: {self.path_to_log_file}")
+            self.f_out.seek(0)
+            self.tail = yield from self._read_to_end(self.f_out, b'')
+
+    def close(self):
+        if self.f_out is not None:
+            self.f_out.close()
+            self.f_out = None
+        if self.rotated is not None:
+            self.rotated.close()
+            self.rotated, self.rotated_tail = None, b''
+
+
+def follow_log(path_to_log_file, report_name, report_dir, interval=60, size=1000, iterations=None, data_file=False,
+               **parse_options):
+    """
+    Режим --follow: раз в interval секунд разбирает дописанные в лог строки, добавляет их
+    к накопленному агрегату и заново строит отчёт. Разбор не повторяется, поэтому стоимость
+    итерации зависит от объёма новых строк и числа url, а не от размера всего лога.
+    :param path_to_log_file:
+    :param report_name:
+    :param report_dir:
+    :param interval: период обновления отчёта в секундах
+    :param size: REPORT_SIZE
+    :param iterations: количество итераций, None - до прерывания
+    :param data_file: писать строки отчёта в отдельный JSON-файл
+    :param parse_options: параметры parse_lines
+    :return: накопленный агрегат
+    """
+    follower = LogFollower(path_to_log_file)
+    sample_rate = parse_options.get('sample_rate')
+    if sample_rate is not None and sample_rate < 1:
+        # иначе каждый опрос начинал бы выборку с того же зерна и выбирал одни и те же по счёту строки
+        parse_options = {**parse_options, 'sampler': LineSampler(sample_rate)}
+    aggregate = parse_lines((), **parse_options)
+    iteration = 0
+    try:
+        while iterations is None or iteration < iterations:
+            if iteration:
+                time.sleep(interval)
+            iteration += 1
+
+            new_aggregate = parse_lines(follower.iter_new_lines(), **parse_options)
+            if new_aggregate['error_rows']:
+                logging.info(f"Unparsed lines in {path_to_log_file}: {new_aggregate['error_rows']}")
+            if not new_aggregate['own_num_rows']:
+                continue
+            aggregate = merge_aggregates([aggregate, new_aggregate], parse_options.get('max_urls'))
+            table = calculate_metrics({'table': aggregate['table'], 'buckets': aggregate['buckets'],
+                                       'heavy_hitters': aggregate['heavy_hitters'],
+                                       'sample_rate': sample_rate,
+                                       'own_num_request': aggregate['own_num_request'],
+                                       'own_sum_request_time': aggregate['own_sum_request_time'] / 1000000},
+                                      size=size)
+            render(table, report_name, report_dir, data_file=data_file)
+            logging.info(f"Live report updated: {aggregate['own_num_request']} requests")
+    finally:
+        follower.close()
+    return aggregate
+
+
+def parse_date_argument(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Incorrect date '{value}', it must be YYYY-MM-DD")
+
+
+def parse_sample_rate(value):
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = None
+    if rate is None or not 0 < rate <= 1:
+        raise argparse.ArgumentTypeError(f"Incorrect sample rate '{value}', it must be in (0, 1]")
+    return rate
+
+
 def create_parser():
     parser = argparse.ArgumentParser(description='Log analyzer')
     parser.add_argument('--config', type=str, default='config.json', help='path to configuration file')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for parsing a log')
+    parser.add_argument('--date-from', type=parse_date_argument, default=None,
+                        help='build a report over logs since this date (YYYY-MM-DD)')
+    parser.add_argument('--date-to', type=parse_date_argument, default=None,
+                        help='build a report over logs up to this date (YYYY-MM-DD)')
+    parser.add_argument('--force', action='store_true', help='rebuild the report even if it already exists')
+    parser.add_argument('--batch', action='store_true',
+                        help='build reports for every log in LOG_DIR that does not have one yet')
+    parser.add_argument('--follow', action='store_true',
+                        help='tail the live log and re-render report-live.html periodically')
+    parser.add_argument('--sample', type=parse_sample_rate, default=None, metavar='RATE',
+                        help='approximate report over a random share of the log (0 < RATE <= 1) '
+                             'with confidence intervals')
+    parser.add_argument('--profile', action='store_true',
+                        help='run under cProfile and tracemalloc, dump the results to the report directory')
     return parser
 
 
+def build_report(log_files, report_name, report_dir, size=1000, snapshot_dir=None, workers=1, data_file=False,
+                 export_format=None, **parse_options):
+    """
+    Разбирает логи (или берёт их снимки), сливает агрегаты и записывает отчёт
+    :param log_files: пути к файлам логов, которые попадают в отчёт
+    :param report_name:
+    :param report_dir:
+    :param size: REPORT_SIZE
+    :param snapshot_dir: None - не использовать снимки
+    :param workers: количество процессов для разбора одного лога
+    :param data_file: писать строки отчёта в отдельный JSON-файл
+    :param export_format: формат выгрузки всех агрегатов рядом с отчётом (get_export_format)
+    :param parse_options: параметры parse_lines
+    :return: путь к отчёту
+    """
+    aggregates = [parse_report_cached(log_file, snapshot_dir, workers=workers, **parse_options)
+                  for log_file in log_files]
+    # итоги по дням берутся до слияния: merge_aggregates накапливает их в первом агрегате
+    days = []
+    for log_file, aggregate in zip(log_files, aggregates):
+        # в приближённом режиме итоги - оценки для всего лога, как count и time_sum url
+        scale = 1 / aggregate['sample_rate'] if aggregate['sample_rate'] else 1
+        days.append({'date': str(extract_date_frome_file_name(os.path.basename(log_file))),
+                     'count': aggregate['own_num_request'] * scale,
+                     'time_sum': aggregate['own_sum_request_time'] * scale})
+    table_dict = merge_aggregates(aggregates, parse_options.get('max_urls'))
+    table = calculate_metrics(table_dict, size=size)
+
+    export_format = get_export_format(export_format)
+    if export_format:
+        os.makedirs(report_dir, exist_ok=True)
+        export_aggregates(table_dict, days,
+                          os.path.join(report_dir, f"{os.path.splitext(report_name)[0]}.{export_format}"))
+
+    with stage_metrics.stage('render'):
+        render(table, report_name, report_dir, data_file=data_file)
+    return os.path.join(report_dir, report_name)
+
+
+def build_batch_report(*args, **kwargs):
+    """
+    Выполняет build_report в процессе пакетного режима. Метрики стадий процесса пула
+    не видны родителю, поэтому они сбрасываются перед каждым логом и возвращаются вместе с отчётом.
+    :return: путь к отчёту и stage_metrics.stages процесса
+    """
+    stage_metrics.reset()
+    return build_report(*args, **kwargs), stage_metrics.stages
+
+
+def limit_worker_memory(memory_mb):
+    """
+    Ограничивает память данных процесса пакетного режима: при превышении бюджета
+    разбор одного лога завершится MemoryError, не затронув остальные. Ограничивается RLIMIT_DATA,
+    а не RLIMIT_AS: отображение файла лога через mmap (parse_chunk) только для чтения
+    в бюджет не входит, поэтому лог может быть больше бюджета.
+    """
+    if memory_mb and resource is not None:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def build_missing_reports(path_to_log_dir, report_dir, size=1000, snapshot_dir=None, concurrency=None,
+                          worker_memory_mb=None, data_file=False, export_format=None, path_to_index=None,
+                          **parse_options):
+    """
+    Пакетный режим: за один просмотр LOG_DIR находит все логи без отчёта в report_dir и строит
+    отчёты параллельно в пуле процессов. Ошибка в одном логе (в том числе превышение допустимого
+    процента ошибок разбора) не останавливает остальные, результаты логируются в порядке дат.
+    :param path_to_log_dir:
+    :param report_dir:
+    :param size: REPORT_SIZE
+    :param snapshot_dir:
+    :param concurrency: количество одновременно обрабатываемых логов, None - по числу ядер
+    :param worker_memory_mb: ограничение памяти на процесс в мегабайтах, None - без ограничения
+    :param data_file: писать строки отчёта в отдельный JSON-файл
+    :param export_format: формат выгрузки всех агрегатов рядом с отчётом (get_export_format)
+    :param path_to_index: индекс scan_log_dir, None - без индекса
+    :param parse_options: параметры parse_lines
+    :return: список путей к построенным отчётам
+    """
+    missing = [(date, path) for date, path in get_log_files(path_to_log_dir, path_to_index=path_to_index)
+               if not os.path.exists(os.path.join(report_dir, f"report-{date:%Y-%m-%d}.html"))]
+    logging.info(f"Logs without a report: {len(missing)}")
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=concurrency, initializer=limit_worker_memory,
+                             initargs=(worker_memory_mb,)) as executor:
+        futures = [(path, executor.submit(build_batch_report, [path], f"report-{date:%Y-%m-%d}.html",
+                                          report_dir, size, snapshot_dir, data_file=data_file,
+                                          export_format=export_format, **parse_options))
+                   for date, path in missing]
+        for path, future in futures:
+            try:
+                report, stages = future.result()
+                stage_metrics.merge(stages)
+                reports.append(report)
+                logging.info(f"Report for {path} has been generated: {reports[-1]}")
+            except BaseException as e:
+                logging.error(f"Unable to build a report for {path}: {e!r}")
+    return reports
+
+
+def get_parse_options(merged_config: dict) -> dict:
+    """
+    Возвращает параметры parse_lines из конфига
+    :param merged_config:
+    :return:
+    """
+    normalizer = None
+    if merged_config['URL_STRIP_QUERY'] or merged_config['URL_REPLACE_IDS'] or merged_config['URL_REWRITE_RULES']:
+        normalizer = UrlNormalizer(strip_query=merged_config['URL_STRIP_QUERY'],
+                                   replace_ids=merged_config['URL_REPLACE_IDS'],
+                                   rewrite_rules=merged_config['URL_REWRITE_RULES'],
+                                   cache_size=merged_config['URL_CACHE_SIZE'])
+    return {'exact': merged_config['EXACT_METRICS'], 'normalizer': normalizer, 'max_urls': merged_config['MAX_URLS'],
+            'bucket_minutes': merged_config['TIME_BUCKET_MINUTES'], 'sample_rate': merged_config['SAMPLE_RATE'],
+            'heavy_hitters': merged_config['SAMPLE_HEAVY_HITTERS'] or None}
+
+
+def start_profiling():
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiling(profiler, report_dir):
+    """
+    Сохраняет результаты cProfile (<время>.prof, для pstats/snakeviz) и tracemalloc (топ аллокаций)
+    в директорию отчётов
+    :param profiler:
+    :param report_dir:
+    :return:
+    """
+    profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    os.makedirs(report_dir, exist_ok=True)
+    path_prefix = os.path.join(report_dir, f"log_analyzer-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+    profiler.dump_stats(f"{path_prefix}.prof")
+    with open(f"{path_prefix}.tracemalloc.txt", "w") as f_in:
+        for statistic in snapshot.statistics('lineno')[:50]:
+            f_in.write(f"{statistic}\n")
+    logging.info(f"Profile has been saved: {path_prefix}.prof, {path_prefix}.tracemalloc.txt")
+
+
+def run(merged_config: dict, args):
+    path_to_log_dir = os.path.abspath(merged_config['LOG_DIR'])
+    path_to_report_dir = os.path.abspath(merged_config['REPORT_DIR'])
+    if args.sample is not None:
+        merged_config = {**merged_config, 'SAMPLE_RATE': args.sample}
+    parse_options = get_parse_options(merged_config)
+    if args.follow:
+        follow_log(os.path.join(path_to_log_dir, merged_config['FOLLOW_LOG']), "report-live.html",
+                   path_to_report_dir, interval=merged_config['FOLLOW_INTERVAL'],
+                   size=merged_config['REPORT_SIZE'], data_file=merged_config['REPORT_DATA_FILE'], **parse_options)
+        return
+
+    # формат выгрузки проверяется до разбора логов, чтобы ошибка в конфиге не стоила целого прохода
+    export_format = get_export_format(merged_config['EXPORT_FORMAT'])
+    snapshot_dir = merged_config['SNAPSHOT_DIR'] and os.path.abspath(merged_config['SNAPSHOT_DIR'])
+    path_to_index = merged_config['LOG_DIR_INDEX'] and os.path.abspath(merged_config['LOG_DIR_INDEX'])
+    if args.batch:
+        build_missing_reports(path_to_log_dir, path_to_report_dir, size=merged_config['REPORT_SIZE'],
+                              snapshot_dir=snapshot_dir, concurrency=merged_config['BATCH_CONCURRENCY'],
+                              worker_memory_mb=merged_config['BATCH_WORKER_MEMORY_MB'],
+                              data_file=merged_config['REPORT_DATA_FILE'], export_format=export_format,
+                              path_to_index=path_to_index, **parse_options)
+        return
+
+    if args.date_from or args.date_to:
+        log_files = [path for _, path in get_log_files(path_to_log_dir, args.date_from, args.date_to,
+                                                               path_to_index)]
+        if not log_files:
+            message = f"There are no logs between {args.date_from} and {args.date_to} in {path_to_log_dir}"
+            logging.info(message)
+            sys.exit(message)
+        date_from = extract_date_frome_file_name(os.path.basename(log_files[0]))
+        date_to = extract_date_frome_file_name(os.path.basename(log_files[-1]))
+        report_name = f"report-{date_from:%Y-%m-%d}_{date_to:%Y-%m-%d}.html"
+    else:
+        log_files = [get_last_log_file(path_to_log_dir, path_to_index)]
+        date_from_log_name = extract_date_frome_file_name(os.path.basename(log_files[0]))
+        report_name = f"report-{date_from_log_name:%Y-%m-%d}.html"
+
+    path_to_new_report_file = os.path.join(path_to_report_dir, report_name)
+    if os.path.exists(path_to_new_report_file) and not args.force:
+        message = f"The newest report has already been generated: {path_to_new_report_file}"
+        logging.info(message)
+        sys.exit(message)
+
+    # counting values for report, merging per-file snapshots for a date range, rendering html template
+    build_report(log_files, report_name, path_to_report_dir, size=merged_config['REPORT_SIZE'],
+                 snapshot_dir=snapshot_dir, workers=args.workers or merged_config['WORKERS'],
+                 data_file=merged_config['REPORT_DATA_FILE'], export_format=export_format, **parse_options)
+
+
 def main(config: dict, args):
+    merged_config = config
+    profiler = None
     try:
         loaded_config = load_config(args.config)
         merged_config = {**config, **loaded_config}
@@ -196,29 +2297,23 @@ def main(config: dict, args):
                             datefmt='%Y.%m.%d %H:%M:%S')
         logging.info("Program started")
 
-        path_to_log_dir = os.path.abspath(merged_config['LOG_DIR'])
-        path_to_report_dir = os.path.abspath(merged_config['REPORT_DIR'])
-        log_file = get_last_log_file(path_to_log_dir)
-        log_name = os.path.basename(log_file)
-        date_from_log_name = extract_date_frome_file_name(log_name)
-        report_name = f"report-{date_from_log_name:%Y-%m-%d}.html"
-
-        path_to_new_report_file = os.path.join(path_to_report_dir, report_name)
-        if os.path.exists(path_to_new_report_file):
-            message = f"The newest report has already been generated: {path_to_new_report_file}"
-            logging.info(message)
-            sys.exit(message)
-
-        # counting values for report
-        table_dict = parse_report(log_file)
-        table = calculate_metrics(table_dict, size=merged_config['REPORT_SIZE'])
-
-        # rendering html template
-        render(json.dumps(table), report_name, path_to_report_dir)
+        stage_metrics.reset()
+        if args.profile:
+            profiler = start_profiling()
+        run(merged_config, args)
 
     except BaseException as e:
         logging.exception(e)
     finally:
+        if profiler is not None:
+            stop_profiling(profiler, os.path.abspath(merged_config['REPORT_DIR']))
+        if stage_metrics.stages:
+            logging.info(f"Stage metrics:\n{stage_metrics.summary()}")
+            if merged_config.get('METRICS_FILE'):
+                try:
+                    stage_metrics.write_prometheus(merged_config['METRICS_FILE'])
+                except OSError as e:
+                    logging.error(f"Unable to write metrics file {merged_config['METRICS_FILE']}: {e.strerror}")
         logging.info("Done!")
 
 
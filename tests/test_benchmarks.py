@@ -0,0 +1,67 @@
+import logging
+import os
+import shutil
+import unittest
+
+from benchmarks.generator import generate_log, iter_log_lines
+from benchmarks.run import compare_results, measure, reset_peak_rss
+from log_analyzer import parse_report
+
+logging.disable(logging.CRITICAL)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBenchmarks, self).setUp()
+
+        self.path_to_temp = os.path.join(os.getcwd(), 'tests', 'temp_benchmarks')
+
+        if os.path.exists(self.path_to_temp):
+            shutil.rmtree(self.path_to_temp)
+
+        os.makedirs(self.path_to_temp)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_temp)
+
+    def test_generator_is_deterministic(self):
+        self.assertEqual(list(iter_log_lines(lines=200, urls=20)), list(iter_log_lines(lines=200, urls=20)))
+        self.assertNotEqual(list(iter_log_lines(lines=200, urls=20)), list(iter_log_lines(lines=200, urls=20, seed=1)))
+
+    def test_generated_log_is_parsed(self):
+        for is_gzip in (False, True):
+            path_to_log_file = os.path.join(self.path_to_temp, 'nginx-access-ui.log-20170629' + ('.gz' if is_gzip else ''))
+            generate_log(path_to_log_file, is_gzip=is_gzip, lines=1000, urls=50, broken_ratio=0.2)
+
+            table_dict = parse_report(path_to_log_file)
+            self.assertLessEqual(len(table_dict['table']), 50)
+            self.assertAlmostEqual(table_dict['own_num_request'], 800, delta=60)
+
+    def test_generator_zipf_skew(self):
+        lines = list(iter_log_lines(lines=2000, urls=100, skew=1.5))
+        top_url_lines = sum(1 for line in lines if '"GET /api/v2/banner/0 ' in line)
+        self.assertGreater(top_url_lines, 2000 * 0.3)
+
+    def test_compare_results(self):
+        baseline = {'results': {'plain': {'parse': {'seconds': 1.0, 'lines_per_second': 1000, 'peak_rss_mb': 100},
+                                          'distinct_urls': 10}}}
+        same = {'results': {'plain': {'parse': {'seconds': 1.05, 'lines_per_second': 950, 'peak_rss_mb': 100},
+                                      'distinct_urls': 10}}}
+        worse = {'results': {'plain': {'parse': {'seconds': 1.5, 'lines_per_second': 700, 'peak_rss_mb': 90},
+                                       'distinct_urls': 10}}}
+
+        self.assertEqual(compare_results(same, baseline, tolerance=0.1), [])
+        self.assertEqual(len(compare_results(worse, baseline, tolerance=0.1)), 2)
+
+    @unittest.skipUnless(reset_peak_rss(), 'peak RSS cannot be reset on this platform')
+    def test_measure_reports_peak_rss_of_each_stage(self):
+        results = {}
+        measure('allocate', results, 1, lambda: len(bytearray(200 * 1024 * 1024)))
+        measure('idle', results, 1, lambda: None)
+        self.assertGreater(results['allocate']['peak_rss_mb'], 200)
+        self.assertLess(results['idle']['peak_rss_mb'], results['allocate']['peak_rss_mb'] - 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
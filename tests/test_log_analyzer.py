@@ -1,13 +1,35 @@
+import contextlib
 import datetime
 import gzip
+import io
 import json
 import logging
 import shutil
+import struct
+import time
 import unittest
+import zlib
+from array import array
 
 import os
 from log_analyzer import load_config, get_last_log_file, render, calculate_metrics, openfile, \
-    extract_date_frome_file_name, create_parser, parse_report
+    extract_date_frome_file_name, create_parser, parse_report, UrlTable, HISTOGRAM_ACCURACY, \
+    select_kth, split_file, parse_chunk, load_gzip_index, parse_request_line, get_snapshot_key, save_snapshot, \
+    load_snapshot, main, config as default_config, LogFollower, follow_log, UrlNormalizer, OTHER_URL, \
+    build_missing_reports, StageMetrics, stage_metrics, iter_buffer_spans, build_report, get_export_format, \
+    load_aggregates, parse_time_bucket, format_time_bucket, get_log_files, SpaceSaving, iter_sampled_spans, \
+    SAMPLE_BLOCK_SIZE, parse_lines, get_table_columns, LineSampler, merge_aggregates, MAX_URLS_HIGH_WATER, \
+    parse_spans, BlockStats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 logging.disable(logging.CRITICAL)
 
@@ -91,6 +113,29 @@ class TestLogAnalyzer(unittest.TestCase):
 
         return patrh_to_gz_file
 
+    def _generate_multi_member_gz_sample(self, file_name="nginx-access-ui.log-20170630", member_size=500,
+                                         is_bgzf=False):
+        path_to_plain_file = self._generate_plain_sample(file_name)
+        path_to_gz_file = f'{path_to_plain_file}.gz'
+
+        with open(path_to_plain_file, 'rb') as f_in:
+            content = f_in.read()
+        os.remove(path_to_plain_file)
+
+        with open(path_to_gz_file, 'wb') as f_out:
+            for offset in range(0, len(content), member_size):
+                block = content[offset:offset + member_size]
+                if not is_bgzf:
+                    f_out.write(gzip.compress(block))
+                    continue
+                compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+                data = compressor.compress(block) + compressor.flush()
+                f_out.write(b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' + struct.pack('<H', 6) +
+                            b'BC' + struct.pack('<HH', 2, len(data) + 25) + data +
+                            struct.pack('<II', zlib.crc32(block), len(block)))
+
+        return path_to_gz_file
+
     def _generate_config_file(self, file_name="config.json", config=None):
 
         if config is None:
@@ -187,6 +232,73 @@ class TestLogAnalyzer(unittest.TestCase):
         with self.assertRaises(SystemExit) as exc:
             get_last_log_file(self.path_to_temp)
 
+    def test_take_last_log_file_ignores_other_files(self):
+        with self.assertRaises(SystemExit):
+            get_last_log_file(self.path_to_temp)
+
+        for name in ("nginx-access-ui.log-20170701.bz2", "nginx-access-ui.log", "README", "app.log-20170702"):
+            open(os.path.join(self.path_to_temp, name), 'w').close()
+        os.makedirs(os.path.join(self.path_to_temp, "archive"))
+        path_to_gz_file = self._generate_gz_sample("nginx-access-ui.log-20170630", is_remove_plain=True)
+        path_to_plain_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+
+        self.assertEqual(get_last_log_file(self.path_to_temp), path_to_plain_file)
+        os.remove(path_to_plain_file)
+        self.assertEqual(get_last_log_file(self.path_to_temp), path_to_gz_file)
+
+    def test_take_last_log_file_skips_wrong_dates(self):
+        path_to_plain_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        self._generate_plain_sample("nginx-access-ui.log-20171399")
+        self._generate_gz_sample("nginx-access-ui.log-20170231", is_remove_plain=True)
+
+        self.assertEqual(get_last_log_file(self.path_to_temp), path_to_plain_file)
+        self.assertEqual(get_log_files(self.path_to_temp),
+                         [(datetime.date(2017, 6, 30), path_to_plain_file)])
+
+    def test_log_dir_index(self):
+        path_to_index = os.path.join(self.path_to_temp, 'log_dir.idx')
+        log_dir = os.path.join(self.path_to_temp, 'log')
+        os.makedirs(log_dir)
+        first = os.path.join(log_dir, "nginx-access-ui.log-20170629")
+        open(first, 'w').close()
+        # директория менялась давно, поэтому индексу можно верить сразу
+        old_mtime = time.time_ns() - 60 * 1000000000
+        os.utime(log_dir, ns=(old_mtime, old_mtime))
+
+        self.assertEqual(get_last_log_file(log_dir, path_to_index), first)
+        self.assertTrue(os.path.exists(path_to_index))
+
+        # пока директория не менялась, список логов берётся из индекса
+        with open(path_to_index) as f:
+            index = json.load(f)
+        index['logs'].append([datetime.date(2017, 6, 30).toordinal(), "nginx-access-ui.log-20170630"])
+        with open(path_to_index, 'w') as f:
+            json.dump(index, f)
+        self.assertEqual([date for date, _ in get_log_files(log_dir, path_to_index=path_to_index)],
+                         [datetime.date(2017, 6, 29), datetime.date(2017, 6, 30)])
+
+        second = os.path.join(log_dir, "nginx-access-ui.log-20170701")
+        open(second, 'w').close()
+        os.utime(log_dir, ns=(index['mtime'] + 1, index['mtime'] + 1))
+        self.assertEqual(get_last_log_file(log_dir, path_to_index), second)
+        self.assertEqual(get_log_files(log_dir, path_to_index=path_to_index),
+                         [(datetime.date(2017, 6, 29), first), (datetime.date(2017, 7, 1), second)])
+
+    def test_log_dir_index_racy_mtime(self):
+        path_to_index = os.path.join(self.path_to_temp, 'log_dir.idx')
+        log_dir = os.path.join(self.path_to_temp, 'log')
+        os.makedirs(log_dir)
+        first = os.path.join(log_dir, "nginx-access-ui.log-20170629")
+        open(first, 'w').close()
+        self.assertEqual(get_last_log_file(log_dir, path_to_index), first)
+
+        # грубое время изменения директории: новый лог создан в тот же тик, время не сдвинулось
+        dir_mtime = os.stat(log_dir).st_mtime_ns
+        second = os.path.join(log_dir, "nginx-access-ui.log-20170630")
+        open(second, 'w').close()
+        os.utime(log_dir, ns=(dir_mtime, dir_mtime))
+        self.assertEqual(get_last_log_file(log_dir, path_to_index), second)
+
     def test_render_if_template_does_not_exist(self):
         table_json = self._generate_table_json()
         report_name = 'test_report.html'
@@ -211,6 +323,76 @@ class TestLogAnalyzer(unittest.TestCase):
 
         self.assertTrue(os.path.exists(report_dir))
 
+    def test_render_streams_rows_and_data_file(self):
+        report_dir = os.path.join(self.path_to_temp, 'reports', )
+        path_to_template = os.path.join(self.abs_path, 'templates', 'report.html')
+        table = json.loads(self._generate_table_json(3))
+
+        render(table, 'streamed.html', report_dir, path_to_template)
+        render(json.dumps(table), 'inline.html', report_dir, path_to_template)
+        with open(os.path.join(report_dir, 'streamed.html')) as streamed, \
+                open(os.path.join(report_dir, 'inline.html')) as inline:
+            self.assertEqual(streamed.read(), inline.read())
+
+        render(table, 'report-2017.06.30.html', report_dir, path_to_template, data_file=True)
+        with open(os.path.join(report_dir, 'report-2017.06.30.json')) as f:
+            self.assertEqual(json.load(f), table)
+        with open(os.path.join(report_dir, 'report-2017.06.30.html')) as f:
+            html = f.read()
+        self.assertIn('var table = null;', html)
+        self.assertIn('var tableDataUrl = "report-2017.06.30.json";', html)
+        self.assertEqual([name for name in os.listdir(report_dir) if name.endswith('.tmp')], [])
+
+    def _check_export_aggregates(self, export_format):
+        first = self._generate_plain_sample("nginx-access-ui.log-20170629")
+        second = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        build_report([first, second], 'report.html', report_dir, size=1, export_format=export_format)
+
+        aggregates = load_aggregates(os.path.join(report_dir, f'report.{export_format}'))
+        # parquet отдаёт колонки pyarrow, npz - массивы numpy
+        table = {name: column.to_pylist() if export_format == 'parquet' else column.tolist()
+                 for name, column in aggregates['table'].items()}
+        table_dict = parse_report(first)
+        self.assertEqual(list(aggregates['days']['date']), ['2017-06-29', '2017-06-30'])
+        self.assertEqual(list(aggregates['days']['count']), [table_dict['own_num_request']] * 2)
+        self.assertEqual(len(table['url']), len(table_dict['table']))
+        self.assertEqual(sum(table['count']), 2 * table_dict['own_num_request'])
+        self.assertAlmostEqual(sum(table['time_perc']), 100)
+        self.assertEqual(sorted(table['url']), sorted(url.decode() for url in table_dict['table'].urls))
+        if export_format == 'npz':
+            # файл читается без pickle: url хранятся байтами UTF-8 с массивом границ
+            with numpy.load(os.path.join(report_dir, 'report.npz'), allow_pickle=False) as arrays:
+                self.assertEqual(arrays['urls_utf8'].dtype, numpy.uint8)
+                self.assertEqual(arrays['urls_offsets'][-1], len(arrays['urls_utf8']))
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_export_aggregates_parquet(self):
+        self._check_export_aggregates('parquet')
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_export_aggregates_npz(self):
+        self._check_export_aggregates('npz')
+
+    def test_export_format_without_dependency(self):
+        self.assertIsNone(get_export_format(None))
+        self.assertEqual(get_export_format('parquet'), 'parquet' if pyarrow else None)
+        self.assertEqual(get_export_format('npz'), 'npz' if numpy else None)
+        with self.assertRaises(SystemExit):
+            get_export_format('csv')
+
+        self._generate_plain_sample("nginx-access-ui.log-20170630")
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        path_to_config_file = self._generate_config_file(config={
+            "REPORT_DIR": report_dir,
+            "LOG_DIR": self.path_to_temp,
+            "SNAPSHOT_DIR": None,
+            "EXPORT_FORMAT": "csv",
+        })
+        main(default_config, create_parser().parse_args(['--config', path_to_config_file]))
+        self.assertNotIn('parse', stage_metrics.stages)
+        self.assertFalse(os.path.exists(report_dir))
+
     def test_calculate_report_if_repot_size_default(self):
         path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
         table_dict = parse_report(path_to_file)
@@ -225,6 +407,598 @@ class TestLogAnalyzer(unittest.TestCase):
         table = calculate_metrics(table_dict, size=report_size)
         self.assertTrue(len(table) == report_size)
 
+    def test_calculate_report_top_rows_by_time_sum(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        table_dict = parse_report(path_to_file)
+        full_table = calculate_metrics(table_dict, size=len(table_dict['table']))
+        table = calculate_metrics(table_dict, size=5)
+
+        self.assertEqual(len(full_table), len(table_dict['table']))
+        self.assertEqual([row['time_sum'] for row in full_table],
+                         sorted((row['time_sum'] for row in full_table), reverse=True))
+        self.assertEqual(table, full_table[:5])
+
+    def test_calculate_report_exact_and_sketch_are_close(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        exact_table = calculate_metrics(parse_report(path_to_file, exact=True))
+        sketch_table = calculate_metrics(parse_report(path_to_file))
+
+        self.assertEqual([row['url'] for row in exact_table], [row['url'] for row in sketch_table])
+        for exact_row, sketch_row in zip(exact_table, sketch_table):
+            self.assertEqual(exact_row['count'], sketch_row['count'])
+            self.assertEqual(exact_row['time_sum'], sketch_row['time_sum'])
+            self.assertAlmostEqual(exact_row['time_med'], sketch_row['time_med'],
+                                   delta=exact_row['time_med'] * HISTOGRAM_ACCURACY + 0.001)
+
+    def test_parse_request_line(self):
+        prefix = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] '
+        suffix = b' 200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
+        cases = [
+            (b'"GET /api/v2/banner/25019354 HTTP/1.1"', (b'/api/v2/banner/25019354', 0.39)),
+            (b'"POST /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/2.0"',
+             (b'/api/1/photogenic_banners/list/?server_name=WIN7RB4', 0.39)),
+            (b'"PROPFIND /export/ HTTP/1.0"', (b'/export/', 0.39)),
+            (b'"0"', None),
+            (b'"GET /api/v2/banner/25019354"', None),
+            (b'"GET /api/v2/banner/25019354 FTP/1.1"', None),
+        ]
+        for request, expected in cases:
+            line = prefix + request + suffix
+            self.assertEqual(parse_request_line(line, 0, len(line)), expected)
+
+        for line_end in (b'0.390 \n', b'0.390\t\r\n', b'0.390  '):
+            line = prefix + b'"GET / HTTP/1.1"' + suffix.replace(b'0.390\n', line_end)
+            self.assertEqual(parse_request_line(line, 0, len(line)), (b'/', 0.39))
+
+        for request_time in (b'-', b'nan', b'inf', b'-Infinity', b'1e400'):
+            line = prefix + b'"GET / HTTP/1.1"' + suffix.replace(b'0.390', request_time)
+            self.assertIsNone(parse_request_line(line, 0, len(line)))
+        self.assertIsNone(parse_request_line(b'', 0, 0))
+        self.assertIsNone(parse_request_line(b'broken "line 0.1', 0, 16))
+
+        buffer = b'garbage' + prefix + b'"GET /a HTTP/1.1"' + suffix + b'garbage'
+        self.assertEqual(parse_request_line(buffer, 7, len(buffer) - 7), (b'/a', 0.39))
+
+        lines = [prefix + b'"GET /a HTTP/1.1"' + suffix,
+                 prefix + b'"GET /b HTTP/1.1"' + suffix.replace(b'0.390', b'nan')]
+        aggregate = parse_lines(lines)
+        self.assertEqual((aggregate['own_num_request'], aggregate['error_rows']), (1, 1))
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer(strip_query=True, replace_ids=True,
+                                   rewrite_rules=[["^/export/appinstall_raw/[^/]+/", "/export/appinstall_raw/{date}/"]])
+        cases = [
+            (b'/api/v2/banner/25019354', b'/api/v2/banner/{id}'),
+            (b'/api/v2/group/7786679/statistic/sites/?date_type=day', b'/api/v2/group/{id}/statistic/sites/'),
+            (b'/api/v2/slot/4705/groups', b'/api/v2/slot/{id}/groups'),
+            (b'/api/v2/internal/banner/24294027/info', b'/api/v2/internal/banner/{id}/info'),
+            (b'/accounts/0c5b3f2a-2f8e-4a1b-9c3d-1234567890ab/', b'/accounts/{uuid}/'),
+            (b'/static/1a2b3c4d5e6f/app.js', b'/static/{hex}/app.js'),
+            (b'/api/v2/deadbeefcafe/', b'/api/v2/deadbeefcafe/'),
+            (b'/export/appinstall_raw/2017-06-29/', b'/export/appinstall_raw/{date}/'),
+            (b'/api/1/photogenic_banners/list/?server_name=WIN7RB4', b'/api/{id}/photogenic_banners/list/'),
+        ]
+        for path, expected in cases:
+            self.assertEqual(normalizer.normalize(path), expected)
+
+        keep_query = UrlNormalizer(replace_ids=True)
+        self.assertEqual(keep_query.normalize(b'/api/v2/banner/1?id=2'), b'/api/v2/banner/{id}?id=2')
+
+    def test_parse_report_with_normalizer_and_url_cap(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        raw = parse_report(path_to_file)
+        normalizer = UrlNormalizer(strip_query=True, replace_ids=True)
+        normalized = parse_report(path_to_file, normalizer=normalizer)
+        parallel = parse_report(path_to_file, workers=2, normalizer=normalizer)
+
+        self.assertLess(len(normalized['table']), len(raw['table']))
+        self.assertIn(b'/api/v2/banner/{id}', normalized['table'])
+        self.assertEqual(calculate_metrics(parallel), calculate_metrics(normalized))
+
+        capped = parse_report(path_to_file, max_urls=3)
+        self.assertEqual(len(capped['table']), 4)
+        self.assertIn(OTHER_URL, capped['table'])
+        self.assertEqual(sum(capped['table'].counts), raw['own_num_request'])
+
+    def test_url_cap_keeps_heavy_urls(self):
+        path_to_file = os.path.join(self.path_to_temp, "nginx-access-ui.log-20170630")
+        line = '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET {} HTTP/1.1" 200 1 "-" "-" "-" "-" "-" {}\n'
+        with open(path_to_file, 'w') as f:
+            f.writelines(line.format(f'/u{number}', 0.1) for number in range(5))
+            f.writelines(line.format('/hot', 0.5) for _ in range(100))
+
+        table = calculate_metrics(parse_report(path_to_file, max_urls=3))
+        self.assertEqual(table[0]['url'], '/hot')
+        self.assertEqual(table[0]['count'], 100)
+        self.assertEqual(sum(row['count'] for row in table), 105)
+
+        serial = parse_report(path_to_file, max_urls=2, bucket_minutes=1)
+        parallel = parse_report(path_to_file, max_urls=2, bucket_minutes=1, workers=3)
+        self.assertEqual(calculate_metrics(serial), calculate_metrics(parallel))
+        self.assertEqual(sorted(serial['buckets'].urls), sorted(parallel['buckets'].urls))
+
+    def test_url_budget_during_parse(self):
+        line = '1.1.1.1 -  - [29/Jun/2017:03:{:02d}:22 +0300] "GET {} HTTP/1.1" 200 1 "-" "-" "-" "-" "-" {}\n'
+        lines = []
+        for number in range(1000):
+            lines.append(line.format(number % 60, f'/u{number}', 0.001).encode())
+            lines.append(line.format(number % 60, '/hot', 0.5).encode())
+
+        aggregate = parse_lines(lines, max_urls=10, bucket_minutes=5)
+        table = aggregate['table']
+        self.assertLessEqual(len(table), MAX_URLS_HIGH_WATER * 10)
+        self.assertEqual(table.counts[table.ids[b'/hot']], 1000)
+        self.assertEqual(sum(table.counts), 2000)
+        self.assertEqual(sum(aggregate['buckets'].counts), 2000)
+        self.assertLessEqual(len(aggregate['buckets']), MAX_URLS_HIGH_WATER * 10 * 12)
+
+        capped = merge_aggregates([aggregate], max_urls=10)
+        self.assertEqual(len(capped['table']), 11)
+        self.assertIn(OTHER_URL, capped['table'])
+        self.assertEqual(sum(capped['table'].counts), 2000)
+
+    def test_url_table_sketch_median(self):
+        values = [i / 1000 for i in range(1, 10001)]
+        exact, sketch = UrlTable(exact=True), UrlTable()
+        exact_id, sketch_id = exact.intern(b'/api/1'), sketch.intern(b'/api/1')
+        for value in values:
+            exact.add(exact_id, value, round(value * 1000000))
+            sketch.add(sketch_id, value, round(value * 1000000))
+
+        self.assertEqual(exact.quantile(exact_id, 0.5), 5.001)
+        self.assertAlmostEqual(sketch.quantile(sketch_id, 0.5), 5.001, delta=5.001 * HISTOGRAM_ACCURACY)
+        self.assertEqual(sketch.time_maxes[sketch_id], 10.0)
+        self.assertEqual(sketch.counts[sketch_id], exact.counts[exact_id])
+
+    def test_select_kth(self):
+        values = array('d', [0.5, 0.1, 0.1, 3.0, 0.0, 0.7, 0.1, 2.5])
+        ordered = sorted(values)
+        for k in range(len(values)):
+            self.assertEqual(select_kth(values, k), ordered[k])
+
+    def test_url_table_merge(self):
+        left, right, whole = UrlTable(), UrlTable(), UrlTable()
+        for table, url, value in ((left, b'/a', 0.0), (left, b'/a', 0.1), (left, b'/a', 0.5), (right, b'/b', 1.0),
+                                  (right, b'/a', 0.2), (right, b'/a', 3.0)):
+            table.add(table.intern(url), value, round(value * 1000000))
+            whole.add(whole.intern(url), value, round(value * 1000000))
+        left.merge(right)
+
+        self.assertEqual(left.urls, whole.urls)
+        self.assertEqual(left.counts, whole.counts)
+        self.assertEqual(left.time_sums_us, whole.time_sums_us)
+        self.assertEqual(left.time_maxes, whole.time_maxes)
+        self.assertEqual(left.sketches[0].buckets, whole.sketches[0].buckets)
+        self.assertEqual(left.quantile(0, 0.5), whole.quantile(0, 0.5))
+        self.assertEqual(left.quantile(1, 0.5), 1.0)
+
+    def test_parse_report_parallel_equals_serial(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        serial = parse_report(path_to_file, exact=True)
+        parallel = parse_report(path_to_file, exact=True, workers=3)
+
+        self.assertEqual(serial['own_num_request'], parallel['own_num_request'])
+        self.assertEqual(serial['own_sum_request_time'], parallel['own_sum_request_time'])
+        self.assertEqual(calculate_metrics(serial), calculate_metrics(parallel))
+
+    def test_parse_time_bucket(self):
+        self.assertEqual(format_time_bucket(parse_time_bucket(b'29/Jun/2017:03:50', 1)), '2017-06-29T03:50')
+        self.assertEqual(format_time_bucket(parse_time_bucket(b'29/Jun/2017:03:50', 15)), '2017-06-29T03:45')
+        self.assertEqual(format_time_bucket(parse_time_bucket(b'01/Jan/2018:00:59', 60)), '2018-01-01T00:00')
+        self.assertIsNone(parse_time_bucket(b'29/Foo/2017:03:50', 5))
+        self.assertIsNone(parse_time_bucket(b'', 5))
+
+        # строка без [$time_local] не попадает в интервалы, даже если буфер начинается с правильного времени
+        buffer = (b'29/Jun/2017:03:50:22 garbage\n'
+                  b'1.1.1.1 -  - "GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.5\n')
+        aggregate = parse_spans(iter_buffer_spans(buffer), bucket_minutes=1)
+        self.assertIn(b'/a', aggregate['table'])
+        self.assertEqual(len(aggregate['buckets']), 0)
+
+    def test_calculate_report_time_series(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        serial = parse_report(path_to_file, bucket_minutes=1)
+        parallel = parse_report(path_to_file, bucket_minutes=1, workers=3, max_urls=5)
+        self.assertEqual(sum(serial['buckets'].counts), serial['own_num_request'])
+        self.assertEqual(sum(parallel['buckets'].counts), parallel['own_num_request'])
+
+        table = calculate_metrics(serial)
+        for row in table:
+            self.assertEqual(sum(point[1] for point in row['time_series']), row['count'])
+            self.assertEqual(max(point[3] for point in row['time_series']), row['time_max'])
+            self.assertEqual([point[0] for point in row['time_series']],
+                             sorted({point[0] for point in row['time_series']}))
+        self.assertNotIn('time_series', calculate_metrics(parse_report(path_to_file))[0])
+
+    def test_space_saving(self):
+        exact, small, left, right = SpaceSaving(10), SpaceSaving(3), SpaceSaving(3), SpaceSaving(3)
+        stream = [(b'/heavy', 100)] * 50 + [(f'/tail/{number}'.encode(), 1) for number in range(500)]
+        stream += [(b'/second', 40)] * 50
+        for number, (url, weight) in enumerate(stream):
+            small.add(url, weight)
+            (left if number % 2 else right).add(url, weight)
+            if number < 60:
+                exact.add(url, weight)
+
+        self.assertEqual(exact.top()[0], (b'/heavy', 5000, 0))
+        self.assertEqual([url for url, _, _ in small.top()[:2]], [b'/heavy', b'/second'])
+        for url, weight, error in small.top()[:2]:
+            self.assertLessEqual(weight - error, {b'/heavy': 5000, b'/second': 2000}[url])
+            self.assertGreaterEqual(weight, {b'/heavy': 5000, b'/second': 2000}[url])
+
+        left.merge(right)
+        self.assertEqual([url for url, _, _ in left.top()[:2]], [b'/heavy', b'/second'])
+        self.assertEqual(SpaceSaving.load(left.dump()).top(), left.top())
+
+    def test_iter_sampled_spans_independent_of_ranges(self):
+        buffer = b''.join(f'line {number}\n'.encode() for number in range(40000))
+        whole = list(iter_sampled_spans(buffer, 0.3))
+        parts = [span for start, end in ((0, 100000), (100000, 250000), (250000, None))
+                 for span in iter_sampled_spans(buffer, 0.3, start, end)]
+
+        self.assertEqual(whole, parts)
+        self.assertLess(0, len(whole), 40000)
+        # строки берутся блоками целиком: строка выбрана вместе с соседями из своего блока
+        starts = {start for _, start, _ in whole}
+        lines = list(iter_sampled_spans(buffer, 1.0))
+        for (_, start, _), (_, next_start, _) in zip(lines, lines[1:]):
+            if start // SAMPLE_BLOCK_SIZE == next_start // SAMPLE_BLOCK_SIZE:
+                self.assertEqual(start in starts, next_start in starts)
+
+    def test_calculate_sampled_report(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        table_dict = parse_report(path_to_file, exact=True)
+        exact = calculate_metrics(table_dict)
+
+        # при доле 1 оценки совпадают с точными значениями, интервалы вырождаются в точку
+        full = calculate_metrics(parse_report(path_to_file, exact=True, sample_rate=1.0, heavy_hitters=5))
+        for exact_row, row in zip(exact, full):
+            for key in ('url', 'count', 'time_sum', 'count_perc', 'time_perc', 'time_med'):
+                self.assertAlmostEqual(row[key], exact_row[key], places=3)
+            self.assertEqual(row['count_perc_ci'], [row['count_perc']] * 2)
+            self.assertEqual(row['time_med_ci'], [row['time_med']] * 2)
+        self.assertLessEqual(full[0]['time_sum_ci'][0], full[0]['time_sum'])
+        self.assertLessEqual(full[0]['time_sum'], full[0]['time_sum_ci'][1])
+
+        sampled = parse_report(path_to_file, sample_rate=0.5, heavy_hitters=3)
+        self.assertLess(sampled['own_num_request'], table_dict['own_num_request'])
+        self.assertEqual(calculate_metrics(sampled), calculate_metrics(parse_report(path_to_file, sample_rate=0.5,
+                                                                                    heavy_hitters=3)))
+        # heavy hitters считаются по всем строкам, а не только по выборке
+        top_row = calculate_metrics(sampled, size=1)[0]
+        self.assertEqual(top_row['url'], exact[0]['url'])
+        self.assertLessEqual(top_row['time_sum_ci'][0], exact[0]['time_sum'])
+        self.assertLessEqual(exact[0]['time_sum'], top_row['time_sum_ci'][1])
+        for row in calculate_metrics(sampled):
+            if row['count'] is not None:
+                self.assertLessEqual(row['count_perc_ci'][0], row['count_perc'])
+                self.assertLessEqual(row['count_perc'], row['count_perc_ci'][1])
+                self.assertLessEqual(row['time_med_ci'][0], row['time_med'])
+                self.assertLessEqual(row['time_med'], row['time_med_ci'][1])
+
+        # интервалы и выгрузка масштабируются на долю выборки так же, как count строки отчёта
+        sampled = parse_report(path_to_file, sample_rate=0.5, heavy_hitters=3, bucket_minutes=1)
+        for row in calculate_metrics(sampled):
+            if row['count'] is not None:
+                self.assertEqual(sum(point[1] for point in row['time_series']), row['count'])
+        columns = get_table_columns(sampled)
+        self.assertAlmostEqual(sum(columns['count']), sampled['own_num_request'] / 0.5)
+        self.assertAlmostEqual(sum(columns['time_sum']), sampled['own_sum_request_time'] / 0.5)
+
+    def test_block_sampled_intervals(self):
+        path_to_file = os.path.join(self.path_to_temp, "nginx-access-ui.log-20170630")
+        with open(path_to_file, 'w') as f_out:
+            for i in range(60000):
+                # /burst приходит одной пачкой в начале файла, /steady - равномерно
+                url = '/burst' if i < 6000 and i % 2 else f'/steady/{i % 3}'
+                f_out.write(f'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 1 "-" "-" "-" "-" "-" '
+                            f'0.{i % 1000:03d}\n')
+
+        sampled = parse_report(path_to_file, sample_rate=0.3)
+        self.assertGreater(sampled['block_stats'].blocks, 10)
+        self.assertEqual(calculate_metrics(parse_report(path_to_file, sample_rate=0.3, workers=3)),
+                         calculate_metrics(sampled))
+
+        # выборка блоками: дисперсия по блокам шире, чем для выборки строк, у url, пришедшего пачкой
+        rows = {row['url']: row for row in calculate_metrics(sampled)}
+        srs_rows = {row['url']: row for row in calculate_metrics({**sampled, 'block_stats': None})}
+        width = lambda row, key: row[key][1] - row[key][0]
+        for key in ('count_perc_ci', 'time_perc_ci', 'time_med_ci'):
+            self.assertGreater(width(rows['/burst'], key), 2 * width(srs_rows['/burst'], key))
+        self.assertLess(width(rows['/steady/0'], 'count_perc_ci'), width(rows['/burst'], 'count_perc_ci'))
+
+        path_to_snapshot = os.path.join(self.path_to_temp, 'snapshots', 'sampled.snapshot')
+        key = get_snapshot_key(path_to_file, sample_rate=0.3)
+        save_snapshot(path_to_snapshot, key, sampled)
+        self.assertEqual(calculate_metrics(load_snapshot(path_to_snapshot, key)), calculate_metrics(sampled))
+
+        # по одному блоку дисперсию не оценить: интервалов нет
+        stats = BlockStats()
+        stats.add_block({b'/one': [3, 300]})
+        self.assertIsNone(stats.ratio_errors(b'/one', 1.0))
+        stats.add_block({b'/one': [1, 100], b'/two': [1, 50]})
+        self.assertIsNotNone(stats.ratio_errors(b'/one', 1.0))
+        self.assertIsNone(stats.ratio_errors(b'/three', 1.0))
+
+    def test_line_sampler_continues_between_calls(self):
+        lines = [f'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET /{i % 7} HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.{i}\n'
+                 .encode() for i in range(1, 1000)]
+        whole = parse_lines(lines, sample_rate=0.3)
+
+        sampler = LineSampler(0.3)
+        parts = [parse_lines(lines[start:start + 100], sample_rate=0.3, sampler=sampler)
+                 for start in range(0, len(lines), 100)]
+        merged = merge_aggregates(parts)
+        self.assertEqual(merged['own_num_request'], whole['own_num_request'])
+        self.assertEqual(dict(zip(merged['table'].urls, merged['table'].counts)),
+                         dict(zip(whole['table'].urls, whole['table'].counts)))
+
+        # без общего состояния каждая часть выбирала бы одни и те же по счёту строки
+        restarted = [parse_lines(lines[start:start + 100], sample_rate=0.3) for start in range(0, len(lines), 100)]
+        self.assertEqual(len({aggregate['own_num_request'] for aggregate in restarted[:-1]}), 1)
+
+    def test_parse_sample_argument(self):
+        self.assertEqual(create_parser().parse_args(['--sample', '0.01']).sample, 0.01)
+        for value in ('0', '1.5', 'abc'):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                create_parser().parse_args(['--sample', value])
+
+    def test_iter_buffer_spans(self):
+        buffer = b'first\nsecond\n\nfourth'
+        lines = lambda start=0, end=None: [buffer[line_start:line_end]
+                                           for _, line_start, line_end in iter_buffer_spans(buffer, start, end)]
+
+        self.assertEqual(lines(), [b'first', b'second', b'', b'fourth'])
+        self.assertEqual(lines(0, 6), [b'first'])
+        self.assertEqual(lines(6), [b'second', b'', b'fourth'])
+        self.assertEqual(lines(7, 14), [b''])
+        self.assertEqual(lines(14), [b'fourth'])
+        self.assertEqual(lines(15), [])
+
+    def test_parse_report_empty_plain_file(self):
+        path_to_file = os.path.join(self.path_to_temp, "nginx-access-ui.log-20170630")
+        open(path_to_file, 'w').close()
+
+        table_dict = parse_report(path_to_file)
+        self.assertEqual(table_dict['own_num_request'], 0)
+        self.assertEqual(len(table_dict['table']), 0)
+
+    def test_parse_report_gz_equals_plain(self):
+        path_to_plain_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        path_to_gz_file = self._generate_gz_sample("nginx-access-ui.log-20170630")
+
+        self.assertEqual(calculate_metrics(parse_report(path_to_plain_file)),
+                         calculate_metrics(parse_report(path_to_gz_file)))
+
+    def test_parse_report_multi_member_gz_builds_index(self):
+        path_to_plain_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        expected = calculate_metrics(parse_report(path_to_plain_file, exact=True))
+        path_to_gz_file = self._generate_multi_member_gz_sample(member_size=333)
+
+        self.assertIsNone(load_gzip_index(path_to_gz_file))
+        serial = calculate_metrics(parse_report(path_to_gz_file, exact=True, workers=2))
+        self.assertTrue(os.path.exists(f'{path_to_gz_file}.idx'))
+        self.assertTrue(len(load_gzip_index(path_to_gz_file)) > 1)
+        parallel = calculate_metrics(parse_report(path_to_gz_file, exact=True, workers=3))
+
+        self.assertEqual(serial, expected)
+        self.assertEqual(parallel, expected)
+
+    def test_parse_report_bgzf_without_cached_index(self):
+        path_to_plain_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        expected = parse_report(path_to_plain_file, exact=True)
+        path_to_gz_file = self._generate_multi_member_gz_sample(member_size=400, is_bgzf=True)
+
+        members = load_gzip_index(path_to_gz_file)
+        self.assertTrue(len(members) > 1)
+        self.assertEqual(members[1][1], 400)
+        parallel = parse_report(path_to_gz_file, exact=True, workers=4)
+
+        self.assertEqual(parallel['own_num_request'], expected['own_num_request'])
+        self.assertEqual(calculate_metrics(parallel), calculate_metrics(expected))
+
+    def test_take_last_log_file_ignores_gzip_index(self):
+        path_to_gz_file = self._generate_multi_member_gz_sample()
+        parse_report(path_to_gz_file)
+
+        self.assertEqual(get_last_log_file(self.path_to_temp), path_to_gz_file)
+
+    def test_parse_chunks_cover_every_line_once(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        with open(path_to_file, 'rb') as f_out:
+            num_lines = len(f_out.readlines())
+
+        for chunks in (1, 2, 7, 100, 10000):
+            parsed = [parse_chunk(path_to_file, start, end) for start, end in split_file(path_to_file, chunks)]
+            self.assertEqual(sum(aggregate['own_num_rows'] for aggregate in parsed), num_lines)
+
+    def test_snapshot_round_trip(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log-20170630")
+        path_to_snapshot = os.path.join(self.path_to_temp, 'snapshots', 'nginx-access-ui.log-20170630.snapshot')
+        for exact in (False, True):
+            table_dict = parse_report(path_to_file, exact=exact)
+            key = get_snapshot_key(path_to_file, exact=exact)
+            save_snapshot(path_to_snapshot, key, table_dict)
+
+            loaded = load_snapshot(path_to_snapshot, key)
+            self.assertEqual(loaded['own_num_request'], table_dict['own_num_request'])
+            self.assertEqual(calculate_metrics(loaded), calculate_metrics(table_dict))
+            self.assertIsNone(load_snapshot(path_to_snapshot, get_snapshot_key(path_to_file, exact=not exact)))
+
+        with open(path_to_file, 'a') as f_out:
+            f_out.write('broken line\n')
+        self.assertIsNone(load_snapshot(path_to_snapshot, get_snapshot_key(path_to_file, exact=True)))
+        self.assertIsNone(load_snapshot(path_to_file, get_snapshot_key(path_to_file, exact=True)))
+
+    def test_main_report_over_date_range(self):
+        for day in ('20170629', '20170630', '20170701'):
+            self._generate_plain_sample(f"nginx-access-ui.log-{day}")
+        path_to_config_file = self._generate_config_file(config={
+            "REPORT_SIZE": 10,
+            "REPORT_DIR": os.path.join(self.path_to_temp, 'reports'),
+            "LOG_DIR": self.path_to_temp,
+            "SNAPSHOT_DIR": os.path.join(self.path_to_temp, 'snapshots'),
+        })
+
+        args = create_parser().parse_args(['--config', path_to_config_file,
+                                           '--date-from', '2017-06-29', '--date-to', '2017-06-30'])
+        main(default_config, args)
+
+        self.assertTrue(os.path.exists(os.path.join(self.path_to_temp, 'reports', 'report-2017-06-29_2017-06-30.html')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path_to_temp, 'snapshots'))),
+                         ['nginx-access-ui.log-20170629.snapshot', 'nginx-access-ui.log-20170630.snapshot'])
+
+    def test_log_follower_reads_appended_lines_and_survives_rotation(self):
+        path_to_file = os.path.join(self.path_to_temp, 'nginx-access-ui.log')
+        follower = LogFollower(path_to_file)
+        self.assertEqual(list(follower.iter_new_lines()), [])
+
+        with open(path_to_file, 'wb') as f_out:
+            f_out.write(b'first\nsecond\nthi')
+        self.assertEqual(list(follower.iter_new_lines()), [b'first', b'second'])
+        self.assertEqual(list(follower.iter_new_lines()), [])
+
+        with open(path_to_file, 'ab') as f_out:
+            f_out.write(b'rd\nfourth')
+        os.rename(path_to_file, f'{path_to_file}.1')
+        with open(path_to_file, 'wb') as f_out:
+            f_out.write(b'fifth\n')
+        self.assertEqual(list(follower.iter_new_lines()), [b'third', b'fifth'])
+
+        # nginx пишет в переименованный файл, пока не получит USR1 и не переоткроет лог
+        with open(f'{path_to_file}.1', 'ab') as f_out:
+            f_out.write(b'-late\nlater')
+        self.assertEqual(list(follower.iter_new_lines()), [b'fourth-late'])
+        # старый файл не менялся целый опрос, а новый уже пишется: старый дочитан и закрыт
+        self.assertEqual(list(follower.iter_new_lines()), [b'later'])
+        with open(f'{path_to_file}.1', 'ab') as f_out:
+            f_out.write(b'ignored\n')
+        self.assertEqual(list(follower.iter_new_lines()), [])
+
+        with open(path_to_file, 'wb') as f_out:
+            f_out.write(b'new\n')
+        self.assertEqual(list(follower.iter_new_lines()), [b'new'])
+        follower.close()
+
+    def test_follow_log_renders_live_report(self):
+        path_to_file = self._generate_plain_sample("nginx-access-ui.log")
+        with open(path_to_file, 'a') as f_out:
+            f_out.write('\n')
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+
+        aggregate = follow_log(path_to_file, 'report-live.html', report_dir, interval=0, size=10, iterations=2)
+
+        self.assertTrue(os.path.exists(os.path.join(report_dir, 'report-live.html')))
+        self.assertEqual(aggregate['own_num_request'], parse_report(path_to_file)['own_num_request'])
+
+    def test_build_missing_reports(self):
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        os.makedirs(report_dir)
+        with open(os.path.join(report_dir, 'report-2017-06-28.html'), 'w') as f_out:
+            f_out.write('already built')
+        self._generate_plain_sample("nginx-access-ui.log-20170628")
+        self._generate_plain_sample("nginx-access-ui.log-20170629")
+        self._generate_gz_sample("nginx-access-ui.log-20170630", is_remove_plain=True)
+        with open(os.path.join(self.path_to_temp, "nginx-access-ui.log-20170701"), 'w') as f_out:
+            f_out.write('broken line\n' * 10)
+
+        reports = build_missing_reports(self.path_to_temp, report_dir, size=10, concurrency=2)
+
+        self.assertEqual([os.path.basename(path) for path in reports], ['report-2017-06-29.html', 'report-2017-06-30.html'])
+        self.assertEqual(sorted(os.listdir(report_dir)),
+                         ['report-2017-06-28.html', 'report-2017-06-29.html', 'report-2017-06-30.html'])
+        with open(os.path.join(report_dir, 'report-2017-06-28.html')) as f_out:
+            self.assertEqual(f_out.read(), 'already built')
+
+    def test_main_batch_collects_worker_metrics(self):
+        log_files = [self._generate_plain_sample("nginx-access-ui.log-20170629"),
+                     self._generate_gz_sample("nginx-access-ui.log-20170630", is_remove_plain=True)]
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        path_to_metrics_file = os.path.join(self.path_to_temp, 'log_analyzer.prom')
+        path_to_config_file = self._generate_config_file(config={
+            "REPORT_DIR": report_dir,
+            "LOG_DIR": self.path_to_temp,
+            "SNAPSHOT_DIR": None,
+            "METRICS_FILE": path_to_metrics_file,
+        })
+
+        main(default_config, create_parser().parse_args(['--config', path_to_config_file, '--batch']))
+
+        expected_lines = 0
+        for log_file in log_files:
+            with openfile(log_file, 'rb') as f_out:
+                expected_lines += sum(1 for _ in f_out)
+        self.assertEqual(stage_metrics.stages['parse']['lines'], expected_lines)
+        self.assertIn('render', stage_metrics.stages)
+        with open(path_to_metrics_file) as f_out:
+            self.assertIn(f'log_analyzer_stage_lines{{stage="parse"}} {expected_lines}', f_out.read())
+
+        metrics = StageMetrics()
+        metrics.merge({'parse': {'wall_seconds': 1.0, 'cpu_seconds': 1.0, 'bytes': 10, 'lines': 2,
+                                 'distinct_urls': 5, 'peak_rss_bytes': None}})
+        metrics.merge({'parse': {'wall_seconds': 0.5, 'cpu_seconds': 0.5, 'bytes': 5, 'lines': 1,
+                                 'distinct_urls': 3, 'peak_rss_bytes': 100}})
+        self.assertEqual(metrics.stages['parse'], {'wall_seconds': 1.5, 'cpu_seconds': 1.5, 'bytes': 15, 'lines': 3,
+                                                   'distinct_urls': 5, 'peak_rss_bytes': 100})
+
+    def test_build_missing_reports_log_larger_than_worker_memory(self):
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        path_to_log_file = self._generate_plain_sample("nginx-access-ui.log-20170629")
+        worker_memory_mb = 256
+        with open(path_to_log_file, 'rb') as f_out:
+            content = f_out.read()
+        # разреженное начало (одна нераспознанная строка): файл больше бюджета памяти, но не занимает места на диске
+        with open(path_to_log_file, 'wb') as f_in:
+            f_in.seek((worker_memory_mb + 64) * 1024 * 1024)
+            f_in.write(b'\n' + content)
+
+        reports = build_missing_reports(self.path_to_temp, report_dir, size=10, concurrency=1,
+                                        worker_memory_mb=worker_memory_mb)
+
+        self.assertEqual([os.path.basename(path) for path in reports], ['report-2017-06-29.html'])
+
+    def test_stage_metrics_nested_stages(self):
+        metrics = StageMetrics()
+        with metrics.stage('parse') as stage:
+            blocks = list(metrics.iter_blocks('read', [b'abc', b'de']))
+            stage['lines'] = 10
+            stage['distinct_urls'] = 3
+
+        self.assertEqual(blocks, [b'abc', b'de'])
+        self.assertEqual(metrics.stages['read']['bytes'], 5)
+        self.assertEqual(metrics.stages['parse']['lines'], 10)
+        self.assertEqual(metrics.stages['parse']['distinct_urls'], 3)
+        self.assertGreaterEqual(metrics.stages['parse']['wall_seconds'], 0)
+        self.assertIn('parse: wall', metrics.summary())
+
+        path_to_metrics_file = os.path.join(self.path_to_temp, 'log_analyzer.prom')
+        metrics.write_prometheus(path_to_metrics_file)
+        with open(path_to_metrics_file) as f_out:
+            content = f_out.read()
+        self.assertIn('# TYPE log_analyzer_stage_wall_seconds gauge', content)
+        self.assertIn('log_analyzer_stage_lines{stage="parse"} 10', content)
+        self.assertIn('log_analyzer_stage_bytes{stage="read"} 5', content)
+
+    def test_main_writes_metrics_and_profile(self):
+        self._generate_gz_sample("nginx-access-ui.log-20170630", is_remove_plain=True)
+        report_dir = os.path.join(self.path_to_temp, 'reports')
+        path_to_metrics_file = os.path.join(self.path_to_temp, 'log_analyzer.prom')
+        path_to_config_file = self._generate_config_file(config={
+            "REPORT_DIR": report_dir,
+            "LOG_DIR": self.path_to_temp,
+            "SNAPSHOT_DIR": None,
+            "METRICS_FILE": path_to_metrics_file,
+        })
+
+        main(default_config, create_parser().parse_args(['--config', path_to_config_file, '--profile']))
+
+        self.assertEqual(set(stage_metrics.stages), {'read', 'parse', 'calculate_metrics', 'render'})
+        self.assertTrue(os.path.exists(path_to_metrics_file))
+        report_files = os.listdir(report_dir)
+        self.assertIn('report-2017-06-30.html', report_files)
+        self.assertTrue(any(name.endswith('.prof') for name in report_files))
+        self.assertTrue(any(name.endswith('.tracemalloc.txt') for name in report_files))
+
     def test_extract_date_frome_normal_file_name(self):
         name = 'nginx-access-ui.log-20170630'
         self.assertIsInstance(extract_date_frome_file_name(name), datetime.date)